@@ -0,0 +1,583 @@
+import os
+import sys
+import json
+import time
+import uuid
+import gzip
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+import tracemalloc
+import multiprocessing
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Benchmark harness for main.py. It starts an in-process fake SW5 REST API and a fake
+# SW6 Admin API with a generated catalog, runs main() against them in a separate process
+# and reports throughput, requests per product and peak memory.
+
+class FakeCatalog:
+    # Generated SW5 articles and media plus the SW6 entities main.py reads and writes
+
+    def __init__(self, products, images, categories, shared_images, image_size, seed=1):
+        rng = random.Random(seed)
+        self.image_size = image_size
+        self.lock = threading.RLock()
+        self.sw5_articles = {}
+        self.sw5_articles_by_id = {}
+        self.sw5_media = {}
+        self.sw6 = {entity: {} for entity in (
+            'product', 'product-media', 'product-visibility', 'media', 'media-folder',
+            'media-folder-configuration', 'media-thumbnail-size', 'category', 'tax', 'sales-channel'
+        )}
+
+        configuration_id = uuid.uuid4().hex
+        self.sw6['media-folder-configuration'][configuration_id] = {
+            "id": configuration_id, "createThumbnails": True, "keepAspectRatio": True, "thumbnailQuality": 80
+        }
+        for tax_rate in (19.0, 7.0):
+            tax_id = uuid.uuid4().hex
+            self.sw6['tax'][tax_id] = {"id": tax_id, "taxRate": tax_rate}
+
+        category_names = [f"Category {i}" for i in range(categories)]
+        media_id = 1
+        shared_media_ids = []
+        for i in range(shared_images):
+            self.sw5_media[media_id] = self._sw5_media(media_id, f"shared_{i}")
+            shared_media_ids.append(media_id)
+            media_id += 1
+
+        for i in range(products):
+            number = f"SW{i + 1:06d}"
+            product_id = uuid.uuid4().hex
+            self.sw6['product'][product_id] = {"id": product_id, "productNumber": number}
+            article_images = [{"mediaId": shared_id} for shared_id in shared_media_ids]
+            for k in range(images):
+                self.sw5_media[media_id] = self._sw5_media(media_id, f"article_{i + 1}_{k + 1}")
+                article_images.append({"mediaId": media_id})
+                media_id += 1
+            article = {
+                "id": i + 1,
+                "name": f"Article {i + 1}",
+                "description": f"Short description {i + 1}",
+                "descriptionLong": f"<p>Long description of article {i + 1}</p>",
+                "metaTitle": f"Article {i + 1}",
+                "active": True,
+                "changed": "2024-01-01T00:00:00+0100",
+                "tax": {"id": 1, "tax": "19.00"},
+                "mainDetail": {
+                    "number": number,
+                    "prices": [{"price": round(rng.uniform(1, 200), 2)}],
+                    "attribute": {"attr4": rng.choice(["true", "false"]), "warenpost": rng.choice(["true", "false"])}
+                },
+                "images": article_images,
+                "categories": [{"name": name} for name in rng.sample(category_names, min(2, len(category_names)))]
+            }
+            self.sw5_articles[number] = article
+            self.sw5_articles_by_id[article['id']] = article
+
+    def add_sales_channel(self, name):
+        sales_channel_id = uuid.uuid4().hex
+        self.sw6['sales-channel'][sales_channel_id] = {
+            "id": sales_channel_id, "name": name, "languageId": uuid.uuid4().hex, "currencyId": uuid.uuid4().hex
+        }
+
+    def _sw5_media(self, media_id, name):
+        return {
+            "id": media_id,
+            "albumId": -1,
+            "name": name,
+            "description": f"Alt text for {name}",
+            "path": f"media/image/{name}.jpg",
+            "extension": "jpg"
+        }
+
+    def media_content(self, path):
+        seed = hashlib.sha256(path.encode('utf-8')).digest()
+        return (seed * (self.image_size // len(seed) + 1))[:self.image_size]
+
+
+def matches_filter(record, query):
+    query_type = query['type']
+    if query_type == 'equals':
+        return record.get(query['field']) == query['value']
+    if query_type == 'equalsAny':
+        values = query['value']
+        if isinstance(values, str):
+            values = values.split('|')
+        return record.get(query['field']) in values
+    if query_type == 'range':
+        value = record.get(query['field'])
+        if value is None:
+            return False
+        parameters = query['parameters']
+        if query['field'] == 'id' or query['field'].endswith('Id'):
+            # Like the DAL, compare the binary ID column with the unconverted hex parameters
+            value = bytes.fromhex(value)
+            parameters = {key: str(parameter).encode('utf-8') for key, parameter in parameters.items()}
+        return all((
+            'gt' not in parameters or value > parameters['gt'],
+            'gte' not in parameters or value >= parameters['gte'],
+            'lt' not in parameters or value < parameters['lt'],
+            'lte' not in parameters or value <= parameters['lte'],
+        ))
+    if query_type == 'not':
+        return not all(matches_filter(record, sub_query) for sub_query in query['queries'])
+    if query_type == 'multi':
+        results = [matches_filter(record, sub_query) for sub_query in query['queries']]
+        return any(results) if query.get('operator', 'and').lower() == 'or' else all(results)
+    raise ValueError(f"Unsupported filter type '{query_type}'")
+
+
+def project(entity, record, includes):
+    fields = (includes or {}).get(entity.replace('-', '_'))
+    if not fields:
+        return dict(record)
+    return {field: record.get(field) for field in fields if field in record or field == 'id'}
+
+
+class RequestStats:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, backend, method, endpoint):
+        with self.lock:
+            key = f"{backend} {method} {endpoint}"
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def total(self, backend=None):
+        with self.lock:
+            return sum(count for key, count in self.counts.items() if backend is None or key.startswith(backend))
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    backend = None
+    catalog = None
+    stats = None
+    latency = 0.0
+    thumbnail_latency = 0.0
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def send_json(self, status, data=None, headers=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, detail):
+        self.send_json(status, {"errors": [{"status": str(status), "detail": detail}]})
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        body = self.read_body()
+        delay = self.latency + self.thumbnail_delay(method, unquote(url.path))
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats.record(self.backend, method, 'throttled')
+            self.send_json(429, {"errors": [{"status": "429", "detail": "Too many requests"}]}, {'Retry-After': '0'})
+            return
+        handler = self.handle_sw5 if self.backend == 'SW5' else self.handle_sw6
+        with self.catalog.lock:
+            endpoint = handler(method, unquote(url.path), parse_qs(url.query), body)
+        self.stats.record(self.backend, method, endpoint)
+
+    # SW5 REST API
+
+    def handle_sw5(self, method, path, query, body):
+        catalog = self.catalog
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['api', 'articles'] and len(parts) == 3:
+            if query.get('useNumberAsId'):
+                article = catalog.sw5_articles.get(parts[2])
+            else:
+                article = catalog.sw5_articles_by_id.get(int(parts[2])) if parts[2].isdigit() else None
+            if article:
+                self.send_json(200, {"success": True, "data": article})
+            else:
+                self.send_json(404, {"success": False, "message": "Article not found"})
+            return '/api/articles/{id}'
+        if parts[:2] == ['api', 'articles']:
+            articles = self.filter_sw5(list(catalog.sw5_articles.values()), query)
+            listing = [
+                dict({field: article[field] for field in ('id', 'name', 'description', 'descriptionLong',
+                                                          'active', 'changed')},
+                     mainDetail={"number": article['mainDetail']['number']})
+                for article in articles
+            ]
+            self.send_sw5_page(listing, query)
+            return '/api/articles'
+        if parts[:2] == ['api', 'media'] and len(parts) == 3:
+            media = catalog.sw5_media.get(int(parts[2])) if parts[2].isdigit() else None
+            if media:
+                self.send_json(200, {"success": True, "data": media})
+            else:
+                self.send_json(404, {"success": False, "message": "Media not found"})
+            return '/api/media/{id}'
+        if parts[:2] == ['api', 'media']:
+            self.send_sw5_page(self.filter_sw5(list(catalog.sw5_media.values()), query), query)
+            return '/api/media'
+        if parts[:2] == ['media', 'image']:
+            content = catalog.media_content(path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return '/media/image/{file}'
+        self.send_json(404, {"success": False, "message": f"Unknown path {path}"})
+        return 'unknown'
+
+    def filter_sw5(self, records, query):
+        # Supports filter[n][property], filter[n][expression] and filter[n][value]
+        filters = {}
+        for key, values in query.items():
+            if key.startswith('filter['):
+                index, field = key[len('filter['):].rstrip(']').split('][')
+                filters.setdefault(index, {})[field] = values[0]
+        for condition in filters.values():
+            field = condition.get('property')
+            expression = condition.get('expression', '=')
+            value = condition.get('value')
+            if expression in ('>', '>='):
+                # Dates are returned as '2024-01-01T00:00:00+0100' but filtered as '2024-01-01 00:00:00'
+                def compared(record):
+                    return str(record.get(field))[:19].replace('T', ' ') if field == 'changed' else str(record.get(field))
+                if expression == '>':
+                    records = [r for r in records if compared(r) > value]
+                else:
+                    records = [r for r in records if compared(r) >= value]
+            else:
+                records = [r for r in records if str(r.get(field)) == value]
+        return records
+
+    def send_sw5_page(self, records, query):
+        start = int(query.get('start', ['0'])[0])
+        limit = int(query.get('limit', ['1000'])[0])
+        self.send_json(200, {"success": True, "data": records[start:start + limit], "total": len(records)})
+
+    # SW6 Admin API
+
+    def handle_sw6(self, method, path, query, body):
+        catalog = self.catalog
+        parts = path.strip('/').split('/')
+        if path == '/api/oauth/token':
+            self.send_json(200, {"token_type": "Bearer", "expires_in": 600, "access_token": "benchmark-token"})
+            return path
+        if self.headers.get('Authorization') != 'Bearer benchmark-token':
+            self.send_error_json(401, "Unauthorized")
+            return 'unauthorized'
+
+        if method == 'POST' and parts[:2] == ['api', 'search'] and len(parts) == 3:
+            self.search(parts[2], json.loads(body or b'{}'))
+            return f'/api/search/{parts[2]}'
+        if method == 'POST' and path == '/api/_action/sync':
+            return self.sync(json.loads(body))
+        if method == 'POST' and parts[:3] == ['api', '_action', 'media'] and len(parts) == 5:
+            return self.media_action(parts[3], parts[4], query, body)
+        if method == 'POST' and len(parts) == 2 and parts[1] in catalog.sw6:
+            payload = json.loads(body)
+            payload.setdefault('id', uuid.uuid4().hex)
+            records = catalog.sw6[parts[1]]
+            if payload['id'] in records:
+                self.send_error_json(400, f"Entity {payload['id']} already exists")
+            else:
+                records[payload['id']] = payload
+                self.send_json(204, headers={'Location': f"/api/{parts[1]}/{payload['id']}"})
+            return f'/api/{parts[1]}'
+        if method == 'PATCH' and len(parts) == 3 and parts[1] in catalog.sw6:
+            record = catalog.sw6[parts[1]].get(parts[2])
+            if record is None:
+                self.send_error_json(404, f"Entity {parts[2]} not found")
+            else:
+                payload = json.loads(body)
+                payload['id'] = parts[2]
+                self.write(parts[1], payload)
+                self.send_json(204)
+            return f'/api/{parts[1]}/{{id}}'
+        self.send_error_json(404, f"Unknown path {path}")
+        return 'unknown'
+
+    def search(self, entity, criteria):
+        if entity not in self.catalog.sw6:
+            self.send_error_json(400, f"Unknown entity {entity}")
+            return
+        records = list(self.catalog.sw6[entity].values())
+        for query in criteria.get('filter', []):
+            records = [record for record in records if matches_filter(record, query)]
+        for sorting in reversed(criteria.get('sort', [])):
+            records.sort(key=lambda record: (record.get(sorting['field']) is None, record.get(sorting['field']) or ''),
+                         reverse=sorting.get('order', 'ASC').upper() == 'DESC')
+        total = len(records)
+        limit = criteria.get('limit') or 500
+        page = criteria.get('page', 1)
+        records = records[(page - 1) * limit:page * limit]
+        includes = criteria.get('includes')
+        associations = criteria.get('associations', {})
+        data = []
+        for record in records:
+            item = project(entity, record, includes)
+            if entity == 'product':
+                for association, related_entity in (('media', 'product-media'), ('visibilities', 'product-visibility')):
+                    if association in associations:
+                        item[association] = [project(related_entity, related, includes)
+                                             for related in self.catalog.sw6[related_entity].values()
+                                             if related['productId'] == record['id']]
+                if 'media' in (associations.get('media') or {}).get('associations', {}):
+                    for product_media in item['media']:
+                        media = self.catalog.sw6['media'].get(product_media.get('mediaId'))
+                        product_media['media'] = project('media', media, includes) if media else None
+                if 'categories' in associations:
+                    item['categories'] = [project('category', self.catalog.sw6['category'][category_id], includes)
+                                          for category_id in record.get('categoryIds', [])
+                                          if category_id in self.catalog.sw6['category']]
+                if 'translations' in associations:
+                    translations = [dict(fields, languageId=language_id)
+                                    for language_id, fields in (record.get('translations') or {}).items()]
+                    for query in associations['translations'].get('filter', []):
+                        translations = [translation for translation in translations
+                                        if matches_filter(translation, query)]
+                    item['translations'] = [project('product-translation', translation, includes)
+                                            for translation in translations]
+            data.append(item)
+        # Like SW6, without total-count-mode the total is the number of returned records
+        result = {"data": data, "total": total if criteria.get('total-count-mode', 0) else len(data)}
+        self.send_json(200, result)
+
+    def creates_thumbnails(self, media):
+        folder = self.catalog.sw6['media-folder'].get(media.get('mediaFolderId')) or {}
+        configuration = self.catalog.sw6['media-folder-configuration'].get(folder.get('configurationId')) or {}
+        return configuration.get('createThumbnails', True)
+
+    def thumbnail_delay(self, method, path):
+        # Thumbnails are created on upload if the folder configuration asks for it, or on request
+        parts = path.strip('/').split('/')
+        if not self.thumbnail_latency or method != 'POST' or parts[:3] != ['api', '_action', 'media'] or len(parts) != 5:
+            return 0.0
+        if parts[4] == 'generate-thumbnails':
+            return self.thumbnail_latency
+        media = self.catalog.sw6['media'].get(parts[3])
+        if parts[4] == 'upload' and media and self.creates_thumbnails(media):
+            return self.thumbnail_latency
+        return 0.0
+
+    def write(self, entity, payload):
+        records = self.catalog.sw6[entity]
+        record = records.setdefault(payload['id'], {"id": payload['id']})
+        for field, value in payload.items():
+            if entity == 'product' and field == 'media':
+                for product_media in value:
+                    self.write('product-media', dict(product_media, productId=payload['id'],
+                                                     id=product_media.get('id') or uuid.uuid4().hex))
+            elif entity == 'product' and field == 'visibilities':
+                for visibility in value:
+                    self.write('product-visibility', dict(visibility, productId=payload['id'],
+                                                          id=visibility.get('id') or uuid.uuid4().hex))
+            elif entity == 'product' and field == 'categories':
+                record['categoryIds'] = [category['id'] for category in value]
+            else:
+                record[field] = value
+
+    def sync(self, operations):
+        # All operations run in one transaction, like the real Sync API
+        for operation in operations.values():
+            entity = operation['entity'].replace('_', '-')
+            for payload in operation['payload']:
+                if entity not in self.catalog.sw6 or not isinstance(payload.get('price'), (list, type(None))):
+                    self.send_error_json(400, f"Invalid payload for {payload.get('id')}")
+                    return '/api/_action/sync'
+        for operation in operations.values():
+            for payload in operation['payload']:
+                self.write(operation['entity'].replace('_', '-'), payload)
+        self.send_json(200, {"success": True})
+        return '/api/_action/sync'
+
+    def media_action(self, media_id, action, query, body):
+        media = self.catalog.sw6['media'].get(media_id)
+        if media is None:
+            self.send_error_json(404, f"Media {media_id} not found")
+            return f'/api/_action/media/{{id}}/{action}'
+        if action == 'generate-thumbnails':
+            media['thumbnailsGenerated'] = True
+            self.send_json(204)
+            return '/api/_action/media/{id}/generate-thumbnails'
+        if action == 'upload':
+            file_name = query.get('fileName', [''])[0]
+            extension = query.get('extension', [''])[0]
+            for other in self.catalog.sw6['media'].values():
+                if other is not media and other.get('fileName') == file_name and other.get('fileExtension') == extension:
+                    self.send_error_json(400, f'A file with the name "{file_name}.{extension}" already exists.')
+                    return '/api/_action/media/{id}/upload'
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                size = self.catalog.image_size
+            else:
+                size = len(body)
+            media.update(fileName=file_name, fileExtension=extension, fileSize=size, hasFile=True,
+                         thumbnailsGenerated=self.creates_thumbnails(media))
+            self.send_json(204)
+            return '/api/_action/media/{id}/upload'
+        self.send_error_json(404, f"Unknown media action {action}")
+        return f'/api/_action/media/{{id}}/{action}'
+
+
+def start_server(backend, catalog, stats, latency, error_rate, thumbnail_latency=0.0):
+    handler = type(f'{backend}Handler', (FakeHandler,), {
+        "backend": backend, "catalog": catalog, "stats": stats, "latency": latency, "error_rate": error_rate,
+        "thumbnail_latency": thumbnail_latency
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def max_rss_mib():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 / 1024 if sys.platform == 'darwin' else usage / 1024
+
+
+def run_migration(migrate_args, environment, directory, verbose, results):
+    # Runs in a fresh process for every run, so main.py starts without the caches and indexes of
+    # an earlier run, like a real rerun, and the memory figures leave out the fake servers
+    os.environ.update(environment)
+    os.chdir(directory)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as migration
+    tracemalloc.start()
+    started = time.perf_counter()
+    if verbose:
+        migration.main(migrate_args)
+    else:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            migration.main(migrate_args)
+    elapsed = time.perf_counter() - started
+    _, peak_memory = tracemalloc.get_traced_memory()
+    results.put((elapsed, peak_memory, max_rss_mib()))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark main.py against in-process fake SW5 and SW6 APIs. "
+                    "Options not listed here are passed on to main.py, e.g. --workers 8 --batch-size 100.")
+    parser.add_argument('--products', type=int, default=200, help="Products in the catalog (default: 200)")
+    parser.add_argument('--images', type=int, default=3, help="Own images per product (default: 3)")
+    parser.add_argument('--shared-images', type=int, default=2,
+                        help="Images every product shares, e.g. brand logos (default: 2)")
+    parser.add_argument('--categories', type=int, default=20, help="Distinct category names (default: 20)")
+    parser.add_argument('--image-size', type=int, default=20000, help="Size of each image in bytes (default: 20000)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Added latency per request in seconds, for both APIs (default: 0)")
+    parser.add_argument('--sw5-latency', type=float, help="Added latency per SW5 request, overrides --latency")
+    parser.add_argument('--sw6-latency', type=float, help="Added latency per SW6 request, overrides --latency")
+    parser.add_argument('--thumbnail-latency', type=float, default=0.0,
+                        help="Time SW6 needs to create the thumbnails of one media, on upload or on request (default: 0)")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Share of requests answered with 429 Too Many Requests (default: 0)")
+    parser.add_argument('--runs', type=int, default=1,
+                        help="Run main() this many times against the same catalog, e.g. to measure reruns")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of main()")
+    return parser.parse_known_args(argv)
+
+
+def main(argv=None):
+    args, migrate_args = parse_args(argv)
+
+    catalog = FakeCatalog(args.products, args.images, args.categories, args.shared_images, args.image_size)
+    stats = RequestStats()
+    sw5_latency = args.latency if args.sw5_latency is None else args.sw5_latency
+    sw6_latency = args.latency if args.sw6_latency is None else args.sw6_latency
+    sw5_server, sw5_url = start_server('SW5', catalog, stats, sw5_latency, args.error_rate)
+    sw6_server, sw6_url = start_server('SW6', catalog, stats, sw6_latency, args.error_rate, args.thumbnail_latency)
+
+    # main.py reads its configuration when it is imported
+    environment = {
+        'SW5_API_URL': sw5_url,
+        'SW5_API_USER': 'benchmark',
+        'SW5_API_KEY': 'benchmark',
+        'SW6_API_URL': sw6_url,
+        'SW6_ACCESS_KEY': 'benchmark',
+        'SW6_SECRET_KEY': 'benchmark',
+        'SW6_MEDIA_FOLDER_NAME': 'Benchmark'
+    }
+    os.environ.update(environment)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as migration
+    catalog.add_sales_channel(migration.SALES_CHANNEL_NAME)
+
+    # Run in a scratch directory, so journals, caches and metrics of real runs stay untouched
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='sw-migration-benchmark-') as scratch:
+        os.chdir(scratch)
+        try:
+            # Spawned processes start with a fresh interpreter instead of a copy of this one
+            context = multiprocessing.get_context('spawn')
+            for run in range(1, args.runs + 1):
+                requests_before = {backend: stats.total(backend) for backend in ('SW5', 'SW6')}
+                results = context.Queue()
+                process = context.Process(target=run_migration,
+                                          args=(migrate_args, environment, scratch, args.verbose, results))
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    sys.exit(f"main.py failed in run {run} with exit code {process.exitcode}.")
+                elapsed, peak_memory, max_rss = results.get()
+
+                sw5_requests = stats.total('SW5') - requests_before['SW5']
+                sw6_requests = stats.total('SW6') - requests_before['SW6']
+                migrated = sum(1 for product in catalog.sw6['product'].values() if product.get('price'))
+                print(f"Run {run}/{args.runs}: {args.products} products, "
+                      f"{args.images + args.shared_images} images each, main.py {' '.join(migrate_args)}")
+                print(f"  Time:             {elapsed:.2f}s")
+                print(f"  Throughput:       {args.products / elapsed:.1f} products/s")
+                print(f"  Requests:         {sw5_requests} SW5, {sw6_requests} SW6, "
+                      f"{(sw5_requests + sw6_requests) / max(args.products, 1):.2f} per product")
+                print(f"  Peak memory:      {peak_memory / 1024 / 1024:.1f} MiB traced"
+                      + (f", {max_rss:.1f} MiB max RSS" if max_rss else ""))
+                print(f"  Products written: {migrated}/{args.products}, "
+                      f"{len(catalog.sw6['media'])} media, {len(catalog.sw6['category'])} categories in SW6")
+            print("Requests by endpoint:")
+            for endpoint, count in sorted(stats.counts.items(), key=lambda item: item[1], reverse=True):
+                print(f"  {count:8d}  {endpoint}")
+        finally:
+            os.chdir(working_directory)
+            sw5_server.shutdown()
+            sw6_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,24 @@ import dotenv
 import uuid
 import time
 import json
-
-from urllib.parse import quote
+import argparse
+import threading
+import sqlite3
+import hashlib
+import random
+import mimetypes
+import tempfile
+import re
+import zlib
+import gzip
+import heapq
+import contextlib
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlparse
+from urllib3.util import make_headers
 
 dotenv.load_dotenv()
 
@@ -25,41 +41,691 @@ SALES_CHANNEL_NAME = "Picksport"
 # Media Folder Name in SW6
 SW6_MEDIA_FOLDER_NAME = os.getenv('SW6_MEDIA_FOLDER_NAME')
 
-SW6_TOKEN = None
-SW6_TOKEN_EXPIRES_AT = 0
-
-def get_sw6_token():
-    global SW6_TOKEN
-    global SW6_TOKEN_EXPIRES_AT
-
-    url = f"{SW6_API_URL}/api/oauth/token"
-    payload = {
-        "client_id": SW6_ACCESS_KEY,
-        "client_secret": SW6_SECRET_KEY,
-        "grant_type": "client_credentials"
-    }
-    response = requests.post(url, data=payload)
-    response.raise_for_status()
-    data = response.json()
-    SW6_TOKEN = data['access_token']
-    expires_in = data.get('expires_in', 3600)  # Default to 3600 seconds if not provided
-    SW6_TOKEN_EXPIRES_AT = time.time() + expires_in - 60  # Refresh 60 seconds before expiry
-
-def ensure_sw6_token():
-    if time.time() >= SW6_TOKEN_EXPIRES_AT:
-        print("Access token expired or about to expire. Refreshing token...")
-        get_sw6_token()
+# Namespace of the IDs generated for shared entities such as categories and media. The same
+# name always maps to the same ID, so parallel workers and shards upsert the same entity
+# instead of creating duplicates. The namespace is fixed rather than derived from SW6_API_URL,
+# because shards may reach the same shop through different URLs and IDs only need to be
+# unique within one shop.
+SW6_ID_NAMESPACE = uuid.UUID('40e7b019-0713-5b25-a4b2-351b8d31d119')
+
+def sw6_entity_id(entity, name):
+    return uuid.uuid5(SW6_ID_NAMESPACE, f"{entity}:{name}").hex
+
+# HTTP connection pool size per backend, raised to the worker count in main()
+HTTP_POOL_SIZE = 10
+
+# Compressed response encodings to accept: gzip and deflate, plus br when the brotli
+# package is installed, since only then urllib3 can decode it
+ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+
+def create_http_session(pool_size):
+    # Session with a keep-alive connection pool, so requests reuse TCP/TLS connections
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+SW5_SESSION = create_http_session(HTTP_POOL_SIZE)
+SW5_SESSION.auth = (SW5_API_USER, SW5_API_KEY)
+SW6_SESSION = create_http_session(HTTP_POOL_SIZE)
+# Media files may be served from another host (e.g. a CDN), so downloads never send the SW5 API credentials
+DOWNLOAD_SESSION = create_http_session(HTTP_POOL_SIZE)
+
+def configure_http_sessions(pool_size):
+    global SW5_SESSION
+    global SW6_SESSION
+    global DOWNLOAD_SESSION
+
+    pool_size = max(pool_size, HTTP_POOL_SIZE)
+    SW5_SESSION.close()
+    SW6_SESSION.close()
+    DOWNLOAD_SESSION.close()
+    SW5_SESSION = create_http_session(pool_size)
+    SW5_SESSION.auth = (SW5_API_USER, SW5_API_KEY)
+    SW6_SESSION = create_http_session(pool_size)
+    DOWNLOAD_SESSION = create_http_session(pool_size)
+
+# Optional request budget per backend in requests per second. Without a budget, requests are
+# only bounded by the number of workers until the backend throttles.
+SW5_RATE_LIMIT = None
+SW6_RATE_LIMIT = None
+DOWNLOAD_RATE_LIMIT = None
+
+# Retries for throttled, unavailable or failed requests
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Connect and read timeout for all requests, uploads by URL can take a while on the SW6 side
+REQUEST_TIMEOUT = (10, 300)
+
+class AdaptiveRateLimiter:
+    # Token bucket per backend whose rate adapts once per window of about a second. It starts
+    # unlimited (or at the optional maximum). When more than `tolerance` of the responses in a
+    # window were throttled (429, or 503 with Retry-After), the rate drops to the part of the
+    # rate actually sent that the backend accepted. Otherwise the rate grows by a tenth of the
+    # current rate, so it keeps up with the backend at any speed and a few stray throttled
+    # responses do not drag it down. Retry-After pauses the whole backend.
+
+    def __init__(self, name, max_rate=None, min_rate=0.5, increase=0.1, tolerance=0.1, window=1.0):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate) if max_rate else min_rate
+        self.increase = increase
+        self.tolerance = tolerance
+        self.window = window
+        # None while unlimited
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        # Requests sent and responses received in the current window, which starts with its first request
+        self.window_start = None
+        self.sent = 0
+        self.responses = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    self._count_sent(now)
+                    return
+                else:
+                    # Refill, allowing bursts of up to one second worth of requests
+                    self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        self._count_sent(now)
+                        return
+                    wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.responses += 1
+            self._adjust(time.monotonic())
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self.responses += 1
+            self.throttled += 1
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            self._adjust(now)
+
+    def _count_sent(self, now):
+        # Must be called with the lock held
+        if self.window_start is None:
+            self.window_start = now
+        self.sent += 1
+
+    def _adjust(self, now):
+        # Must be called with the lock held, adapts the rate once the window is over
+        if self.window_start is None or now - self.window_start < self.window or not self.responses:
+            return
+        sent_rate = self.sent / (now - self.window_start)
+        throttled_share = self.throttled / self.responses
+        if throttled_share > self.tolerance:
+            # Start from the rate that was really sent, an unlimited or idle limiter may be far above it
+            current = sent_rate if self.rate is None else min(self.rate, sent_rate)
+            rate = max(self.min_rate, current * (1.0 - throttled_share))
+            print(f"{self.name} throttled {throttled_share:.0%} of the requests, "
+                  f"lowering rate to {rate:.1f} requests/s.")
+            self.rate = rate
+            self.tokens = min(self.tokens, 0.0)
+            self.updated_at = now
+        elif self.rate is not None:
+            self.rate += max(self.rate * self.increase, 1.0)
+            if self.max_rate:
+                self.rate = min(self.max_rate, self.rate)
+        self.window_start = None
+        self.sent = 0
+        self.responses = 0
+        self.throttled = 0
+
+SW5_RATE_LIMITER = AdaptiveRateLimiter('SW5', SW5_RATE_LIMIT)
+SW6_RATE_LIMITER = AdaptiveRateLimiter('SW6', SW6_RATE_LIMIT)
+# Media downloads may hit another host than the SW5 API (e.g. a CDN), so they have their own budget
+DOWNLOAD_RATE_LIMITER = AdaptiveRateLimiter('Download', DOWNLOAD_RATE_LIMIT)
+
+def configure_rate_limits(sw5_rate, sw6_rate, download_rate, max_retries, backoff=1.0):
+    global SW5_RATE_LIMITER
+    global SW6_RATE_LIMITER
+    global DOWNLOAD_RATE_LIMITER
+    global MAX_RETRIES
+    global RETRY_BACKOFF
+
+    SW5_RATE_LIMITER = AdaptiveRateLimiter('SW5', sw5_rate)
+    SW6_RATE_LIMITER = AdaptiveRateLimiter('SW6', sw6_rate)
+    DOWNLOAD_RATE_LIMITER = AdaptiveRateLimiter('Download', download_rate)
+    MAX_RETRIES = max_retries
+    RETRY_BACKOFF = backoff
+
+def parse_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), RETRY_BACKOFF_MAX)
+
+def retry_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+
+def is_idempotent_request(method, url):
+    # Searches, Sync API upserts and thumbnail generation are POSTs, but repeating them does no harm
+    return method.upper() in ('GET', 'HEAD', 'PUT', 'PATCH', 'DELETE') or '/api/search/' in url \
+        or '/api/_action/sync' in url or url.endswith('/generate-thumbnails')
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def normalize_endpoint(url):
+    # Group URLs by endpoint, with IDs and product numbers replaced by placeholders
+    path = urlparse(url).path
+    if '/api/' not in path:
+        return 'media-download'
+    path = path[path.index('/api/'):]
+    path = re.sub(r'^/api/articles/[^/]+', '/api/articles/{id}', path)
+    path = re.sub(r'/(?:[0-9a-f]{32}|\d+)(?=/|$)', '/{id}', path)
+    return path
+
+class MetricsRecorder:
+    # Thread-safe per-backend and per-endpoint request statistics: counts by status code,
+    # bytes transferred and a latency histogram
+
+    def __init__(self):
+        self.endpoints = {}
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def record_request(self, backend, method, url, status, seconds, bytes_sent, bytes_received):
+        key = (backend, method.upper(), normalize_endpoint(url))
+        with self.lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = {
+                    "requests": 0,
+                    "status": {},
+                    "bytes_sent": 0,
+                    "bytes_received": 0,
+                    "seconds": 0.0,
+                    "buckets": [0] * len(LATENCY_BUCKETS)
+                }
+                self.endpoints[key] = stats
+            stats["requests"] += 1
+            stats["status"][str(status)] = stats["status"].get(str(status), 0) + 1
+            stats["bytes_sent"] += bytes_sent
+            stats["bytes_received"] += bytes_received
+            stats["seconds"] += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {key: dict(stats, status=dict(stats["status"]), buckets=list(stats["buckets"]))
+                    for key, stats in self.endpoints.items()}
+
+    def summary(self, progress=None):
+        endpoints = []
+        for (backend, method, endpoint), stats in sorted(self.snapshot().items()):
+            endpoints.append({
+                "backend": backend,
+                "method": method,
+                "endpoint": endpoint,
+                "requests": stats["requests"],
+                "status": stats["status"],
+                "bytes_sent": stats["bytes_sent"],
+                "bytes_received": stats["bytes_received"],
+                "total_seconds": round(stats["seconds"], 3),
+                "average_seconds": round(stats["seconds"] / stats["requests"], 4),
+                "latency_buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                            stats["buckets"] + [stats["requests"]]))
+            })
+        summary = {
+            "started_at": self.started_at,
+            "elapsed_seconds": round(time.time() - self.started_at, 3),
+            "endpoints": endpoints
+        }
+        if progress:
+            summary["products"] = progress.snapshot()
+        return summary
+
+    def write_summary(self, path, progress=None):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(progress), f, indent=2)
+
+    def print_summary(self, limit=10):
+        # Endpoints that took the most time overall, to see where a slow run spends it
+        endpoints = sorted(self.snapshot().items(), key=lambda item: item[1]["seconds"], reverse=True)
+        print("Slowest endpoints by total time:")
+        for (backend, method, endpoint), stats in endpoints[:limit]:
+            print(f"  {backend} {method} {endpoint}: {stats['requests']} requests, "
+                  f"{stats['seconds']:.1f}s total, {stats['seconds'] / stats['requests'] * 1000:.0f}ms average, "
+                  f"{(stats['bytes_sent'] + stats['bytes_received']) / 1024 / 1024:.1f} MiB")
+
+    def prometheus_text(self, progress=None):
+        lines = [
+            "# TYPE migration_http_requests_total counter",
+            "# TYPE migration_http_request_duration_seconds histogram",
+            "# TYPE migration_http_bytes_sent_total counter",
+            "# TYPE migration_http_bytes_received_total counter"
+        ]
+        for (backend, method, endpoint), stats in sorted(self.snapshot().items()):
+            labels = f'backend="{backend}",method="{method}",endpoint="{endpoint}"'
+            for status, count in sorted(stats["status"].items()):
+                lines.append(f'migration_http_requests_total{{{labels},status="{status}"}} {count}')
+            for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+                lines.append(f'migration_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'migration_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats["requests"]}')
+            lines.append(f'migration_http_request_duration_seconds_sum{{{labels}}} {stats["seconds"]:.6f}')
+            lines.append(f'migration_http_request_duration_seconds_count{{{labels}}} {stats["requests"]}')
+            lines.append(f'migration_http_bytes_sent_total{{{labels}}} {stats["bytes_sent"]}')
+            lines.append(f'migration_http_bytes_received_total{{{labels}}} {stats["bytes_received"]}')
+        if progress:
+            products = progress.snapshot()
+            lines.append("# TYPE migration_products_total counter")
+            for outcome, count in sorted(products["outcomes"].items()):
+                lines.append(f'migration_products_total{{outcome="{outcome}"}} {count}')
+            lines.append(f"migration_products_expected {products['total']}")
+            lines.append(f"migration_products_per_minute {products['products_per_minute']}")
+            if products['eta_seconds'] is not None:
+                lines.append(f"migration_eta_seconds {products['eta_seconds']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, progress=None):
+        # Write atomically, so the node exporter textfile collector never reads a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text(progress))
+        os.replace(tmp_path, path)
+
+METRICS = MetricsRecorder()
+
+# Per-product phases reported by the tracer, in the order they run
+TRACE_PHASES = ('sw5_fetch', 'sw5_media', 'media_lookup', 'media_upload', 'categories', 'product_write')
+
+class Tracer:
+    # Optional span tracing of the product loop. Spans are streamed to a Chrome trace-event JSON file
+    # with one track per worker thread, where the phases of a product nest inside its product span.
+    # Perfetto and chrome://tracing can open it. Phase times are also summed per product for the
+    # report of the slowest products, which keeps only the top products in memory.
+
+    def __init__(self):
+        self.file = None
+        self.top = 10
+        self.started = time.perf_counter()
+        self.first_event = True
+        self.thread_ids = {}
+        self.slowest = []
+        self.phase_totals = {}
+        self.products = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def open(self, path, top=10):
+        # Starts a new trace and report, e.g. for another main() run in the same process
+        with self.lock:
+            self.file = open(path, 'w', encoding='utf-8')
+            self.file.write("[\n")
+            self.top = top
+            self.started = time.perf_counter()
+            self.first_event = True
+            self.thread_ids = {}
+            self.slowest = []
+            self.phase_totals = {}
+            self.products = 0
+
+    def _emit(self, event):
+        # Must be called with the lock held
+        self.file.write(("" if self.first_event else ",\n") + json.dumps(event, separators=(',', ':')))
+        self.first_event = False
+
+    def _write(self, name, start, end, args):
+        thread = threading.current_thread()
+        with self.lock:
+            if self.file is None:
+                return
+            tid = self.thread_ids.get(thread.ident)
+            if tid is None:
+                tid = len(self.thread_ids) + 1
+                self.thread_ids[thread.ident] = tid
+                self._emit({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread.name}})
+            self._emit({
+                "name": name,
+                "cat": "migration",
+                "ph": "X",
+                "pid": 1,
+                "tid": tid,
+                "ts": round((start - self.started) * 1e6, 1),
+                "dur": round((end - start) * 1e6, 1),
+                "args": args
+            })
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if self.file is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            # Phases run on the worker thread of their product
+            phases = getattr(self.local, 'phases', None)
+            if phases is not None:
+                phases[name] = phases.get(name, 0.0) + end - start
+            self._write(name, start, end, args)
+
+    @contextlib.contextmanager
+    def product(self, article_number):
+        if self.file is None:
+            yield
+            return
+        self.local.phases = {}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            phases = self.local.phases
+            self.local.phases = None
+            self._write('product', start, end, {"product": article_number})
+            with self.lock:
+                self.products += 1
+                for phase, seconds in phases.items():
+                    self.phase_totals[phase] = self.phase_totals.get(phase, 0.0) + seconds
+                entry = (end - start, article_number, phases)
+                if len(self.slowest) < self.top:
+                    heapq.heappush(self.slowest, entry)
+                elif entry[0] > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, entry)
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write("\n]\n")
+            self.file.close()
+            self.file = None
+
+    def print_report(self):
+        with self.lock:
+            slowest = sorted(self.slowest, key=lambda entry: entry[0], reverse=True)
+            phase_totals = dict(self.phase_totals)
+            products = self.products
+        if not products:
+            return
+        print(f"Time by phase over {products} products:")
+        for phase in TRACE_PHASES:
+            if phase in phase_totals:
+                print(f"  {phase}: {phase_totals[phase]:.1f}s total, {phase_totals[phase] / products * 1000:.0f}ms average")
+        print(f"Slowest {len(slowest)} products by phase:")
+        for seconds, article_number, phases in slowest:
+            breakdown = ", ".join(f"{phase} {phases[phase]:.2f}s" for phase in TRACE_PHASES if phase in phases)
+            print(f"  {article_number}: {seconds:.2f}s ({breakdown})")
+
+TRACER = Tracer()
+
+class PrometheusTextfileWriter:
+    # Rewrites the Prometheus textfile periodically while the migration runs
+
+    def __init__(self, path, interval, progress):
+        self.path = path
+        self.interval = interval
+        self.progress = progress
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                METRICS.write_prometheus(self.path, self.progress)
+            except OSError as e:
+                print(f"Could not write Prometheus textfile '{self.path}': {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        METRICS.write_prometheus(self.path, self.progress)
+
+# Print method, endpoint, status and payload sizes of every request (--log-requests)
+LOG_REQUESTS = False
+
+def request_size(request):
+    length = request.headers.get('Content-Length')
+    if length:
+        return int(length)
+    return len(request.body) if isinstance(request.body, (bytes, str)) else 0
+
+def response_size(response):
+    # Bytes received over the wire, less than the decoded content for compressed responses
+    try:
+        return response.raw.tell()
+    except AttributeError:
+        return len(response.content)
+
+def format_size(size):
+    if size < 1024:
+        return f"{size} B"
+    return f"{size / 1024:.1f} KiB"
+
+def log_request(backend, method, url, status, seconds, bytes_sent, bytes_received, body_size, content_size):
+    sent = format_size(bytes_sent)
+    if body_size is not None and body_size != bytes_sent:
+        sent += f" ({format_size(body_size)} uncompressed)"
+    received = format_size(bytes_received)
+    if content_size is not None and content_size != bytes_received:
+        received += f" ({format_size(content_size)} decoded)"
+    print(f"{backend} {method} {normalize_endpoint(url)} {status}: sent {sent}, received {received}, "
+          f"{seconds * 1000:.0f}ms")
+
+def send_request(session, limiter, method, url, body_size=None, **kwargs):
+    # Send a rate limited request. Throttled requests (429) were not processed and are
+    # always retried, server errors and connection problems only for idempotent requests.
+    # body_size is the size of the body before compression, for the request log.
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    idempotent = is_idempotent_request(method, url)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        body = kwargs.get('data')
+        if hasattr(body, 'seek'):
+            # Rewind file bodies that were already sent by a previous attempt
+            body.seek(0)
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            METRICS.record_request(limiter.name, method, url, 'error', time.perf_counter() - started, 0, 0)
+            if not idempotent or attempt >= MAX_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+            print(f"{limiter.name} request {method} {url} failed ({e}), retrying in {delay:.1f}s...")
+        else:
+            if kwargs.get('stream'):
+                # Streamed bodies are not read yet, count the announced size
+                bytes_received = int(response.headers.get('Content-Length') or 0)
+                content_size = None
+            else:
+                content_size = len(response.content)
+                bytes_received = response_size(response)
+            seconds = time.perf_counter() - started
+            bytes_sent = request_size(response.request)
+            METRICS.record_request(limiter.name, method, url, response.status_code, seconds, bytes_sent, bytes_received)
+            if LOG_REQUESTS:
+                log_request(limiter.name, method, url, response.status_code, seconds, bytes_sent, bytes_received,
+                            body_size, content_size)
+            retry_after = parse_retry_after(response)
+            # A 503 without Retry-After is an ordinary server error rather than throttling
+            throttled = response.status_code == 429 or (response.status_code == 503 and retry_after is not None)
+            if throttled:
+                limiter.on_throttle(retry_after)
+            else:
+                limiter.on_success()
+            retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUS_CODES)
+            if not retryable or attempt >= MAX_RETRIES:
+                return response
+            delay = retry_after
+            if delay is None:
+                delay = retry_delay(attempt)
+            print(f"{limiter.name} returned {response.status_code} for {method} {url}, "
+                  f"retrying in {delay:.1f}s...")
+            # Release the pooled connection of a streamed response that is never read
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+class SW6TokenManager:
+    # Holds the SW6 access token and refreshes it ahead of expiry.
+    # Only one thread refreshes at a time; the others wait and reuse the new token.
+
+    def __init__(self, refresh_margin=60):
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        url = f"{SW6_API_URL}/api/oauth/token"
+        payload = {
+            "client_id": SW6_ACCESS_KEY,
+            "client_secret": SW6_SECRET_KEY,
+            "grant_type": "client_credentials"
+        }
+        response = send_request(SW6_SESSION, SW6_RATE_LIMITER, 'POST', url, data=payload)
+        response.raise_for_status()
+        data = response.json()
+        expires_in = data.get('expires_in', 3600)  # Default to 3600 seconds if not provided
+        # Refresh ahead of expiry, but never later than halfway through short-lived tokens
+        margin = min(self.refresh_margin, expires_in / 2)
+        self.token = data['access_token']
+        self.expires_at = time.time() + expires_in - margin
+
+    def get_token(self):
+        if time.time() < self.expires_at:
+            return self.token
+        with self.lock:
+            # Another thread may have refreshed the token while we were waiting
+            if time.time() >= self.expires_at:
+                print("Access token expired or about to expire. Refreshing token...")
+                self.refresh()
+            return self.token
+
+    def invalidate(self, token):
+        # Force a refresh on next use, unless another thread already replaced the token
+        with self.lock:
+            if token == self.token:
+                self.expires_at = 0
+
+SW6_TOKENS = SW6TokenManager()
 
 def sw6_headers():
-    ensure_sw6_token()
     return {
-        'Authorization': f'Bearer {SW6_TOKEN}',
+        'Authorization': f'Bearer {SW6_TOKENS.get_token()}',
         'Content-Type': 'application/json',
         'Accept': 'application/json'
     }
 
+# Gzip JSON request bodies of at least COMPRESS_MIN_BYTES (--compress-requests). Shopware
+# does not decode compressed bodies itself, the web server in front of it has to.
+COMPRESS_REQUESTS = False
+COMPRESS_MIN_BYTES = 16 * 1024
+
+def configure_payloads(compress_requests, compress_min_bytes, log_requests):
+    global COMPRESS_REQUESTS
+    global COMPRESS_MIN_BYTES
+    global LOG_REQUESTS
+
+    COMPRESS_REQUESTS = compress_requests
+    COMPRESS_MIN_BYTES = compress_min_bytes
+    LOG_REQUESTS = log_requests
+
+def encode_json_body(payload, headers):
+    # Compact JSON with UTF-8 text instead of \u escapes, gzipped when large enough.
+    # Returns the body and its size before compression.
+    body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False, allow_nan=False).encode('utf-8')
+    if COMPRESS_REQUESTS and len(body) >= COMPRESS_MIN_BYTES:
+        headers['Content-Encoding'] = 'gzip'
+        return gzip.compress(body, compresslevel=6), len(body)
+    return body, len(body)
+
+def sw6_request(method, url, headers=None, **kwargs):
+    # Send an authenticated request to the SW6 Admin API over the shared session
+    global COMPRESS_REQUESTS
+
+    request_headers = sw6_headers()
+    if headers:
+        request_headers.update(headers)
+    if 'json' in kwargs:
+        kwargs['data'], kwargs['body_size'] = encode_json_body(kwargs.pop('json'), request_headers)
+    response = send_request(SW6_SESSION, SW6_RATE_LIMITER, method, url, headers=request_headers, **kwargs)
+    if response.status_code == 415 and request_headers.get('Content-Encoding') == 'gzip':
+        # The server does not accept compressed bodies, send all of them uncompressed from now on
+        print("SW6 does not accept gzip compressed request bodies, disabling request compression.")
+        COMPRESS_REQUESTS = False
+        del request_headers['Content-Encoding']
+        kwargs['data'] = gzip.decompress(kwargs['data'])
+        response = send_request(SW6_SESSION, SW6_RATE_LIMITER, method, url, headers=request_headers, **kwargs)
+    if response.status_code == 401:
+        # The token was revoked or expired early; refresh it once and retry
+        SW6_TOKENS.invalidate(request_headers['Authorization'][len('Bearer '):])
+        request_headers.update(Authorization=f'Bearer {SW6_TOKENS.get_token()}')
+        response = send_request(SW6_SESSION, SW6_RATE_LIMITER, method, url, headers=request_headers, **kwargs)
+    return response
+
+def sw6_search(entity, payload):
+    # Search SW6 entities, e.g. sw6_search('media-folder', payload). Unless the payload selects
+    # fields with includes, only the IDs are returned, and the total is only counted when the
+    # payload asks for it with total-count-mode.
+    payload = dict(payload)
+    payload.setdefault("includes", {entity.replace('-', '_'): ["id"]})
+    payload.setdefault("total-count-mode", 0)
+    return sw6_request('POST', f"{SW6_API_URL}/api/search/{entity}", json=payload)
+
+def sw6_search_all(entity, payload, page_size=500):
+    # Yield all matching SW6 entities page by page for one-off index loads. Pages are read
+    # by offset sorted by id: a keyset on id does not work, because DAL range filters compare
+    # the hex value with the binary id column instead of converting it like equals filters.
+    page = 1
+    while True:
+        page_payload = dict(payload, sort=[{"field": "id", "order": "ASC"}], limit=page_size, page=page)
+        page_payload["total-count-mode"] = 0
+        response = sw6_search(entity, page_payload)
+        response.raise_for_status()
+        entries = response.json().get('data', [])
+        if entries:
+            yield entries
+        if len(entries) < page_size:
+            break
+        page += 1
+
+def sw5_request(method, url, **kwargs):
+    # Send a request to the SW5 REST API over the shared session
+    return send_request(SW5_SESSION, SW5_RATE_LIMITER, method, url, **kwargs)
+
 def get_sales_channel_info():
-    url = f"{SW6_API_URL}/api/search/sales-channel"
     payload = {
         "filter": [
             {
@@ -73,7 +739,7 @@ def get_sales_channel_info():
             "sales_channel": ["id", "languageId", "currencyId"]
         }
     }
-    response = requests.post(url, json=payload, headers=sw6_headers())
+    response = sw6_search('sales-channel', payload)
     response.raise_for_status()
     data = response.json()
 
@@ -92,7 +758,6 @@ def get_sales_channel_info():
 
 def get_sw6_media_folder_id():
     # Search for the media folder by name
-    url = f"{SW6_API_URL}/api/search/media-folder"
     payload = {
         "filter": [
             {
@@ -103,7 +768,7 @@ def get_sw6_media_folder_id():
         ],
         "limit": 1
     }
-    response = requests.post(url, json=payload, headers=sw6_headers())
+    response = sw6_search('media-folder', payload)
     response.raise_for_status()
     data = response.json()
     total = data.get('total', 0)
@@ -118,32 +783,23 @@ def create_sw6_media_folder():
     # Get default configuration ID for media folders
     configuration_id = get_default_media_folder_configuration_id()
 
-    url = f"{SW6_API_URL}/api/media-folder"
+    # Upsert with an ID derived from the name, so shards creating the folder at the same time get the same one
+    media_folder_id = sw6_entity_id('media_folder', SW6_MEDIA_FOLDER_NAME)
     payload = {
+        "id": media_folder_id,
         "name": SW6_MEDIA_FOLDER_NAME,
         "useParentConfiguration": True,
         "configurationId": configuration_id
     }
-    response = requests.post(url, json=payload, headers=sw6_headers())
-    response.raise_for_status()
-
-    if response.content:
-        data = response.json()
-        return data['id']
-    else:
-        # No content in response, try to find the media folder again
-        media_folder_id = get_sw6_media_folder_id()
-        if not media_folder_id:
-            raise Exception("Failed to create or retrieve media folder.")
-        return media_folder_id
+    sync_sw6_upsert('media_folder', [payload])
+    return media_folder_id
 
 def get_default_media_folder_configuration_id():
     # Get default configuration ID for media folders
-    url = f"{SW6_API_URL}/api/search/media-folder-configuration"
     payload = {
         "limit": 1
     }
-    response = requests.post(url, json=payload, headers=sw6_headers())
+    response = sw6_search('media-folder-configuration', payload)
     response.raise_for_status()
     data = response.json()
     if data.get('data'):
@@ -151,50 +807,87 @@ def get_default_media_folder_configuration_id():
     else:
         raise Exception("No media folder configuration found in SW6.")
 
-def get_sw6_products():
-    url = f"{SW6_API_URL}/api/search/product"
-    products = []
-    page = 1
-    limit = 500  # Maximum allowed by Shopware
+def count_sw6_products():
+    # One count query up front, so the progress output can show the remaining products
+    payload = {
+        "includes": {
+            "product": ["id"]
+        },
+        "limit": 1,
+        "total-count-mode": 1
+    }
+    response = sw6_search('product', payload)
+    response.raise_for_status()
+    return response.json().get('total', 0)
 
-    while True:
-        payload = {
-            "includes": {
-                "product": ["id", "productNumber"]
-            },
-            "limit": limit,
-            "page": page,
-            "total-count-mode": 1  # Ensure total count is returned
-        }
-        response = requests.post(url, json=payload, headers=sw6_headers())
-        response.raise_for_status()
-        data = response.json()
+def sw6_product_search_payload(page_size):
+    # Product search with the fields and associations migrate_product() needs
+    return {
+        "associations": {
+            "media": {},
+            "visibilities": {}
+        },
+        "includes": {
+            "product": ["id", "productNumber", "media", "visibilities"],
+            "product_media": ["id", "mediaId", "position"],
+            "product_visibility": ["id", "salesChannelId", "visibility"]
+        },
+        "sort": [{"field": "productNumber", "order": "ASC"}],
+        "limit": page_size,
+        "total-count-mode": 0
+    }
 
-        total = data.get('total', 0)
+def get_sw6_products(page_size=500, search_payload=sw6_product_search_payload):
+    # Yield SW6 products page by page, so migration can start after the first page.
+    # Pages are read by keyset on productNumber instead of page offsets, which keeps
+    # every page equally fast on large tables. Products without a number are never
+    # migrated, so the range filter leaving them out does not lose anything.
+    # Existing product media and visibilities are loaded as associations of the same search.
+    last_product_number = None
+    fetched = 0
 
-        if not data.get('data'):
+    while True:
+        payload = search_payload(page_size)
+        if last_product_number is not None:
+            payload["filter"] = [
+                {"type": "range", "field": "productNumber", "parameters": {"gt": last_product_number}}
+            ]
+        response = sw6_search('product', payload)
+        response.raise_for_status()
+        products = response.json().get('data', [])
+        if not products:
             break
 
-        products.extend(data['data'])
-        print(f"Fetched page {page} with {len(data['data'])} products. Total fetched so far: {len(products)}")
+        fetched += len(products)
+        print(f"Fetched page with {len(products)} products. Total fetched so far: {fetched}")
+        yield products
 
-        if len(products) >= total:
-            print("All products have been fetched.")
+        if len(products) < page_size:
             break
-
-        page += 1
-
-        # Respect Shopware API rate limits
-        time.sleep(0.5)  # Adjust the sleep time as needed
-
-    print(f"Total number of products fetched from Shopware: {len(products)}")
-    return products
+        last_product_number = products[-1]['productNumber']
+
+    print(f"Total number of products fetched from Shopware: {fetched}")
+
+def get_sw6_products_by_number(article_numbers, page_size=500):
+    # Yield the SW6 products with the given numbers page by page, in the same shape as get_sw6_products()
+    fetched = 0
+    for start in range(0, len(article_numbers), page_size):
+        payload = sw6_product_search_payload(page_size)
+        payload["filter"] = [
+            {"type": "equalsAny", "field": "productNumber", "value": article_numbers[start:start + page_size]}
+        ]
+        response = sw6_search('product', payload)
+        response.raise_for_status()
+        products = response.json().get('data', [])
+        fetched += len(products)
+        if products:
+            yield products
+    print(f"Found {fetched} of {len(article_numbers)} requested products in Shopware.")
 
 def get_sw5_product(article_number):
     url = f"{SW5_API_URL}/api/articles/{quote(article_number)}"
-    auth = (SW5_API_USER, SW5_API_KEY)
     params = {'useNumberAsId': True}
-    response = requests.get(url, auth=auth, params=params)
+    response = sw5_request('GET', url, params=params)
     if response.status_code == 200:
         return response.json()['data']
     elif response.status_code == 404:
@@ -202,16 +895,226 @@ def get_sw5_product(article_number):
     else:
         response.raise_for_status()
 
-def get_sw5_media(media_id):
+def get_sw5_product_by_id(article_id):
+    url = f"{SW5_API_URL}/api/articles/{article_id}"
+    response = sw5_request('GET', url)
+    if response.status_code == 200:
+        return response.json()['data']
+    elif response.status_code == 404:
+        return None
+    else:
+        response.raise_for_status()
+
+def get_sw5_article_listing(page_size=1000, workers=1):
+    # Page through the SW5 article listing and map main product numbers to listing entries
+    articles = {}
+    for entries in get_sw5_pages(f"{SW5_API_URL}/api/articles", page_size=page_size, workers=workers):
+        for article in entries:
+            number = (article.get('mainDetail') or {}).get('number')
+            if number:
+                articles[number] = article
+    print(f"Fetched SW5 article listing with {len(articles)} articles.")
+    return articles
+
+def sw5_article_is_complete(article):
+    # The listing lacks most nested data that main() needs, the detail endpoint has it all
+    main_detail = article.get('mainDetail') or {}
+    return (all(field in article for field in ('tax', 'images', 'categories'))
+            and all(field in main_detail for field in ('prices', 'attribute')))
+
+# Default location of the high-water mark of incremental runs
+SYNC_STATE_FILE = 'migration-sync-state.json'
+
+def sw5_changed_timestamp(article):
+    # SW5 returns e.g. '2024-05-01T13:45:00+0200', filters compare with '2024-05-01 13:45:00' in shop time
+    changed = article.get('changed')
+    if not isinstance(changed, str) or len(changed) < 19:
+        return None
+    return changed[:19].replace('T', ' ')
+
+def get_sw5_changed_articles(since, page_size=1000, workers=1):
+    # SW5 listing entries of all articles changed at or after `since`, keyed by main product number
+    params = {
+        'filter[0][property]': 'changed',
+        'filter[0][expression]': '>=',
+        'filter[0][value]': since
+    }
+    articles = {}
+    for entries in get_sw5_pages(f"{SW5_API_URL}/api/articles", params, page_size, workers):
+        for article in entries:
+            number = (article.get('mainDetail') or {}).get('number')
+            if number:
+                articles[number] = article
+    print(f"Found {len(articles)} SW5 articles changed since {since}.")
+    return articles
+
+def read_sync_state(path=SYNC_STATE_FILE):
+    try:
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if state.get('sw5_api_url') != SW5_API_URL or state.get('sw6_api_url') != SW6_API_URL:
+        print(f"Ignoring sync state '{path}' of other shops.")
+        return {}
+    return state
+
+def write_sync_state(path, high_water_mark):
+    state = {
+        "sw5_api_url": SW5_API_URL,
+        "sw6_api_url": SW6_API_URL,
+        "high_water_mark": high_water_mark,
+        "updated_at": time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, path)
+
+class SW5ArticleStore:
+    # Source of SW5 articles for the product loop.
+    # Without a listing every article is fetched with its own request by product number.
+    # With a listing, full details are prefetched in parallel for a chunk of products, and
+    # numbers that are not in the listing (e.g. variant numbers) fall back to the single GET.
+
+    def __init__(self, listing=None, workers=4):
+        self.listing = listing
+        self.workers = workers
+        self.articles = {}
+        self.lock = threading.Lock()
+
+    def _fetch(self, article_number):
+        article = self.listing.get(article_number) if self.listing is not None else None
+        if article is None:
+            return get_sw5_product(article_number)
+        if sw5_article_is_complete(article):
+            return article
+        return get_sw5_product_by_id(article['id'])
+
+    def prefetch(self, article_numbers):
+        if self.listing is None:
+            return
+        with self.lock:
+            missing = [number for number in article_numbers
+                       if number in self.listing and number not in self.articles]
+        if not missing:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._fetch, number): number for number in missing}
+            for future in as_completed(futures):
+                try:
+                    article = future.result()
+                except Exception as e:
+                    # get() will try again and report the error for this product
+                    print(f"Error prefetching SW5 article {futures[future]}: {e}")
+                    continue
+                with self.lock:
+                    self.articles[futures[future]] = article
+
+    def get(self, article_number):
+        # Each article is read once, so drop it from the store to keep memory flat
+        with self.lock:
+            if article_number in self.articles:
+                return self.articles.pop(article_number)
+        return self._fetch(article_number)
+
+    def product_numbers(self):
+        # Main and variant numbers of all prefetched articles
+        with self.lock:
+            numbers = set()
+            for article in self.articles.values():
+                if article:
+                    numbers.update(sw5_article_numbers(article))
+        return numbers
+
+def fetch_sw5_media(media_id):
     url = f"{SW5_API_URL}/api/media/{media_id}"
-    auth = (SW5_API_USER, SW5_API_KEY)
-    response = requests.get(url, auth=auth)
+    response = sw5_request('GET', url)
     if response.status_code == 200:
         return response.json()['data']
     else:
         print(f"Error fetching media with ID {media_id} from SW5.")
         return None
 
+# Maximum number of SW5 media records kept in memory
+SW5_MEDIA_CACHE_SIZE = 200000
+
+# Only the fields needed for the upload are cached, to keep the entries small
+SW5_MEDIA_FIELDS = ('id', 'name', 'path', 'description', 'extension')
+
+class SW5MediaCache:
+    # Bounded LRU cache of SW5 media metadata, filled lazily or in bulk from /api/media.
+    # Concurrent misses for the same media ID wait for a single request.
+
+    def __init__(self, max_entries=SW5_MEDIA_CACHE_SIZE, fetch=fetch_sw5_media):
+        self.max_entries = max_entries
+        self.fetch = fetch
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def _store(self, media_id, media_data):
+        # Must be called with the lock held
+        self.entries[media_id] = {field: media_data.get(field) for field in SW5_MEDIA_FIELDS}
+        self.entries.move_to_end(media_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def prefetch(self, album_id=None, page_size=1000):
+        url = f"{SW5_API_URL}/api/media"
+        start = 0
+        fetched = 0
+        while True:
+            params = {'limit': page_size, 'start': start}
+            if album_id is not None:
+                params['filter[0][property]'] = 'albumId'
+                params['filter[0][value]'] = album_id
+            response = sw5_request('GET', url, params=params)
+            response.raise_for_status()
+            data = response.json()
+            entries = data.get('data', [])
+            with self.lock:
+                for media_data in entries:
+                    self._store(str(media_data['id']), media_data)
+            fetched += len(entries)
+            start += len(entries)
+            if not entries or start >= data.get('total', 0):
+                break
+        print(f"Prefetched {fetched} SW5 media records.")
+
+    def get(self, media_id):
+        key = str(media_id)
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    return dict(self.entries[key])
+                event = self.in_flight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.in_flight[key] = event
+                    break
+            # Another worker is fetching this media record, wait for its result
+            event.wait()
+
+        try:
+            media_data = self.fetch(media_id)
+            if media_data:
+                with self.lock:
+                    self._store(key, media_data)
+                    return dict(self.entries[key])
+            return None
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+SW5_MEDIA_CACHE = SW5MediaCache()
+
+def get_sw5_media(media_id):
+    with TRACER.span('sw5_media', media_id=media_id):
+        return SW5_MEDIA_CACHE.get(media_id)
+
 def get_sw5_media_url_and_extension(media_data):
     # Extract media URL from SW5 media data
     path = media_data['path']
@@ -226,153 +1129,717 @@ def get_sw5_media_url_and_extension(media_data):
     extension = os.path.splitext(path)[1][1:]  # Get extension without the dot
     return media_url, extension
 
-def get_existing_media_id(filename_base, extension):
-    url = f"{SW6_API_URL}/api/search/media"
-    payload = {
-        "filter": [
-            {"type": "equals", "field": "fileName", "value": filename_base},
-            {"type": "equals", "field": "fileExtension", "value": extension}
-        ],
-        "limit": 1
-    }
-    response = requests.post(url, json=payload, headers=sw6_headers())
-    response.raise_for_status()
-    data = response.json()
-    if data.get('data'):
-        return data['data'][0]['id']
-    else:
-        return None
-
-def upload_media_to_sw6(media_url, media_folder_id, filename_base, extension, alt_text):
-    # Check if media already exists
-    existing_media_id = get_existing_media_id(filename_base, extension)
-    if existing_media_id:
-        print(f"Media '{filename_base}.{extension}' already exists in SW6. Using existing media ID.")
-        # Optionally update alt text if needed
-        update_media_alt_text(existing_media_id, alt_text)
-        return existing_media_id
-
-    # Generate a UUID for the new media entity
-    media_id = uuid.uuid4().hex
-
-    # Create a new media entity in SW6 with the specified media_id and mediaFolderId
-    url = f"{SW6_API_URL}/api/media"
-    payload = {
-        "id": media_id,
-        "mediaFolderId": media_folder_id,
-        "alt": alt_text
-    }
-    response = requests.post(url, json=payload, headers=sw6_headers())
-    response.raise_for_status()
-
-    # Upload the media file to SW6 using the media_id by providing the URL of the image
-    # Include the filename without extension and the extension separately
-    upload_url = f"{SW6_API_URL}/api/_action/media/{media_id}/upload?fileName={quote(filename_base)}&extension={extension}"
-    headers = {
-        'Authorization': f'Bearer {SW6_TOKEN}',
-        'Content-Type': 'application/json'
-    }
-    upload_payload = {
-        "url": media_url
-    }
-    response = requests.post(upload_url, json=upload_payload, headers=headers)
-    try:
+def get_sw5_image_info(media_data, idx_img):
+    # Get media URL, filename base, extension, and alt text
+    sw5_media_url, extension = get_sw5_media_url_and_extension(media_data)
+    filename_base = media_data.get('name', f"image_{idx_img}")
+    filename_base = os.path.splitext(filename_base)[0]  # Remove existing extension
+    if not extension:
+        extension = 'jpg'  # Default to 'jpg' if extension is missing
+    alt_text = media_data.get('description', '')
+    return sw5_media_url, filename_base, extension, alt_text
+
+# Default location of the offline SW5 snapshot
+SNAPSHOT_FILE = 'sw5-snapshot.sqlite'
+
+# SW5 articles fetched and written per chunk while creating a snapshot
+SNAPSHOT_CHUNK_SIZE = 1000
+
+def get_sw5_pages(url, params=None, page_size=1000, workers=1):
+    # Page through a SW5 listing endpoint and yield the records of each page.
+    # The first page tells the total, the remaining pages are fetched in parallel.
+    def fetch_page(start):
+        response = sw5_request('GET', url, params=dict(params or {}, limit=page_size, start=start))
         response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        print(f"Error uploading media for product: {e}")
-        print(f"Response content: {response.text}")
-        raise
+        return response.json()
+
+    first_page = fetch_page(0)
+    entries = first_page.get('data', [])
+    yield entries
+    # SW5 may return fewer records than requested, continue with the page size it used
+    stride = len(entries)
+    if not stride or stride >= first_page.get('total', 0):
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page in executor.map(fetch_page, range(stride, first_page['total'], stride)):
+            yield page.get('data', [])
+
+def encode_snapshot_record(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+def decode_snapshot_record(blob):
+    return json.loads(zlib.decompress(blob))
+
+def sw5_article_numbers(article):
+    # Main and variant numbers, get_sw5_product() returns the same article for each of them
+    numbers = {(article.get('mainDetail') or {}).get('number')}
+    numbers.update(detail.get('number') for detail in article.get('details') or [])
+    numbers.discard(None)
+    return numbers
+
+class SW5Snapshot:
+    # Offline copy of SW5 articles and media metadata written by the 'snapshot' command.
+    # Articles are stored once as compressed JSON and indexed by all their product numbers,
+    # so it can replace SW5ArticleStore and the SW5 media requests in main().
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS snapshot_info (key TEXT PRIMARY KEY, value TEXT);"
+        "CREATE TABLE IF NOT EXISTS articles (id INTEGER PRIMARY KEY, data BLOB NOT NULL);"
+        "CREATE TABLE IF NOT EXISTS article_numbers ("
+        " product_number TEXT PRIMARY KEY, article_id INTEGER NOT NULL);"
+        "CREATE TABLE IF NOT EXISTS media (id TEXT PRIMARY KEY, data BLOB NOT NULL);"
+    )
+
+    def __init__(self, path=SNAPSHOT_FILE):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"SW5 snapshot '{path}' not found, create it with: python3 main.py snapshot")
+        self.path = path
+        self.articles = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.info = dict(self.connection.execute("SELECT key, value FROM snapshot_info").fetchall())
+        # Like the reference cache and the sync state, a snapshot is only valid for the shop it came from
+        if self.info.get('sw5_api_url') != SW5_API_URL:
+            self.connection.close()
+            raise ValueError(f"SW5 snapshot '{path}' was created from {self.info.get('sw5_api_url')}, "
+                             f"not from {SW5_API_URL}")
+        print(f"Reading SW5 data from snapshot '{path}' created {self.info.get('created_at')} "
+              f"with {self.info.get('articles')} articles and {self.info.get('media')} media.")
+
+    def _load(self, article_numbers):
+        # Must be called with the lock held
+        articles = {}
+        for start in range(0, len(article_numbers), 500):
+            chunk = article_numbers[start:start + 500]
+            rows = self.connection.execute(
+                "SELECT n.product_number, a.data FROM article_numbers n JOIN articles a ON a.id = n.article_id"
+                f" WHERE n.product_number IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            for product_number, data in rows:
+                articles[product_number] = decode_snapshot_record(data)
+        return articles
+
+    def prefetch(self, article_numbers):
+        # Read the articles of a page in one query
+        with self.lock:
+            missing = [number for number in article_numbers if number not in self.articles]
+            self.articles.update(self._load(missing))
+
+    def get(self, article_number):
+        with self.lock:
+            if article_number in self.articles:
+                return self.articles.pop(article_number)
+            return self._load([article_number]).get(article_number)
+
+    def get_media(self, media_id):
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM media WHERE id = ?", (str(media_id),)).fetchone()
+        if row is None:
+            print(f"Media with ID {media_id} not found in the SW5 snapshot.")
+            return None
+        return decode_snapshot_record(row[0])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def create_sw5_snapshot(path=SNAPSHOT_FILE, workers=8, album_id=None):
+    # Export all SW5 articles and media metadata. The snapshot is written to a temporary
+    # file and renamed at the end, so a failed export keeps the previous snapshot.
+    started = time.time()
+    temp_path = f"{path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.executescript(SW5Snapshot.SCHEMA)
+
+        article_ids = []
+        for entries in get_sw5_pages(f"{SW5_API_URL}/api/articles", workers=workers):
+            article_ids.extend(article['id'] for article in entries)
+        print(f"Exporting {len(article_ids)} SW5 articles with {workers} workers.")
+
+        exported = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(article_ids), SNAPSHOT_CHUNK_SIZE):
+                chunk = article_ids[start:start + SNAPSHOT_CHUNK_SIZE]
+                futures = {executor.submit(get_sw5_product_by_id, article_id): article_id for article_id in chunk}
+                articles = []
+                numbers = []
+                for future in as_completed(futures):
+                    try:
+                        article = future.result()
+                    except Exception as e:
+                        print(f"Error exporting SW5 article {futures[future]}: {e}")
+                        failed.append(futures[future])
+                        continue
+                    if not article:
+                        continue
+                    articles.append((article['id'], encode_snapshot_record(article)))
+                    numbers.extend((number, article['id']) for number in sw5_article_numbers(article))
+                connection.executemany("INSERT OR REPLACE INTO articles (id, data) VALUES (?, ?)", articles)
+                connection.executemany(
+                    "INSERT OR REPLACE INTO article_numbers (product_number, article_id) VALUES (?, ?)", numbers)
+                connection.commit()
+                exported += len(articles)
+                print(f"Exported {exported}/{len(article_ids)} SW5 articles.")
+
+        params = {}
+        if album_id is not None:
+            params = {'filter[0][property]': 'albumId', 'filter[0][value]': album_id}
+        media_count = 0
+        for entries in get_sw5_pages(f"{SW5_API_URL}/api/media", params, workers=workers):
+            connection.executemany("INSERT OR REPLACE INTO media (id, data) VALUES (?, ?)", [
+                (str(media_data['id']), encode_snapshot_record({field: media_data.get(field) for field in SW5_MEDIA_FIELDS}))
+                for media_data in entries
+            ])
+            media_count += len(entries)
+        print(f"Exported {media_count} SW5 media records.")
+
+        connection.executemany("INSERT OR REPLACE INTO snapshot_info (key, value) VALUES (?, ?)", [
+            ('created_at', time.strftime('%Y-%m-%d %H:%M:%S')),
+            ('sw5_api_url', SW5_API_URL),
+            ('articles', str(exported)),
+            ('media', str(media_count))
+        ])
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temp_path, path)
+
+    print(f"SW5 snapshot '{path}' written in {time.time() - started:.0f}s: {exported} articles, "
+          f"{media_count} media, {os.path.getsize(path) / 1024 / 1024:.1f} MiB.")
+    if failed:
+        print(f"{len(failed)} articles could not be exported and are missing from the snapshot: "
+              f"{', '.join(str(article_id) for article_id in sorted(failed))}")
+
+# Default directory of the local media download cache
+DOWNLOAD_CACHE_DIR = '.media-cache'
+
+class MediaDownloadCache:
+    # Content-addressed cache of SW5 media files for binary uploads.
+    # Files are stored once per SHA-256 under blobs/, and urls/ maps each URL to the hash
+    # of its content, so reruns do not download again and identical files share the bytes.
+    # Downloads run on a separate worker pool and are streamed to disk.
+
+    def __init__(self, directory=DOWNLOAD_CACHE_DIR, workers=8):
+        self.directory = directory
+        for subdirectory in ('blobs', 'urls', 'tmp'):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.directory, 'blobs', content_hash[:2], content_hash)
+
+    def _url_path(self, url):
+        return os.path.join(self.directory, 'urls', hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def _write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'tmp'))
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def cached_path(self, url):
+        try:
+            with open(self._url_path(url)) as f:
+                content_hash = f.read().strip()
+        except FileNotFoundError:
+            return None
+        blob_path = self._blob_path(content_hash)
+        return blob_path if os.path.exists(blob_path) else None
+
+    def _download(self, url):
+        blob_path = self.cached_path(url)
+        if blob_path:
+            return blob_path
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                response = send_request(DOWNLOAD_SESSION, DOWNLOAD_RATE_LIMITER, 'GET', url, stream=True)
+                with response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        digest.update(chunk)
+                        f.write(chunk)
+            content_hash = digest.hexdigest()
+            blob_path = self._blob_path(content_hash)
+            if os.path.exists(blob_path):
+                print(f"Downloaded file {url} is identical to a cached file, reusing it.")
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._write_atomic(self._url_path(url), content_hash)
+        return blob_path
+
+    def _submit(self, url):
+        with self.lock:
+            future = self.in_flight.get(url)
+            if future is not None:
+                return future
+            future = self.executor.submit(self._download, url)
+            self.in_flight[url] = future
+        # Registered outside the lock: a future that is already done runs the callback right away
+        future.add_done_callback(lambda _: self._done(url, future))
+        return future
+
+    def _done(self, url, future):
+        with self.lock:
+            if self.in_flight.get(url) is future:
+                del self.in_flight[url]
+
+    def prefetch(self, url):
+        # Start downloading in the background, get() picks up the result
+        if not self.cached_path(url):
+            self._submit(url)
+
+    def get(self, url):
+        blob_path = self.cached_path(url)
+        if blob_path:
+            return blob_path
+        return self._submit(url).result()
+
+    def close(self):
+        self.executor.shutdown()
+
+class MediaIndex:
+    # In-memory (fileName, fileExtension) -> {id, alt} index of all SW6 media with a file.
+    # SW6 file names are unique across all folders, so the whole media table is indexed.
+
+    def __init__(self):
+        self.media = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def load(self, page_size=500):
+        media = {}
+        payload = {
+            "filter": [
+                {"type": "not", "queries": [
+                    {"type": "equals", "field": "fileName", "value": None}
+                ]}
+            ],
+            "includes": {
+                "media": ["id", "fileName", "fileExtension", "alt"]
+            }
+        }
+        for entries in sw6_search_all('media', payload, page_size):
+            for entry in entries:
+                key = (entry.get('fileName'), entry.get('fileExtension'))
+                media.setdefault(key, {"id": entry['id'], "alt": entry.get('alt')})
+        with self.lock:
+            for key, entry in media.items():
+                self.media.setdefault(key, entry)
+            self.loaded = True
+        print(f"Loaded {len(media)} media files from SW6.")
+
+    def ensure_loaded(self):
+        with self.load_lock:
+            if not self.loaded:
+                self.load()
+
+    def get(self, filename_base, extension):
+        self.ensure_loaded()
+        with self.lock:
+            entry = self.media.get((filename_base, extension))
+            return dict(entry) if entry else None
+
+    def add(self, filename_base, extension, media_id, alt_text):
+        with self.lock:
+            self.media[(filename_base, extension)] = {"id": media_id, "alt": alt_text}
+
+MEDIA_INDEX = MediaIndex()
+
+class MediaRegistry:
+    # Run-wide single-flight registry of SW6 media by file name. The first product that needs
+    # a file creates or looks up the media entity; products that need the same file meanwhile
+    # wait for that result, and later products reuse the SW6 media ID directly.
+    # Failures are not kept, so the next product tries again.
+
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, key, create):
+        with self.lock:
+            future = self.results.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.results[key] = future
+        if owner:
+            try:
+                future.set_result(create())
+            except Exception as e:
+                with self.lock:
+                    del self.results[key]
+                future.set_exception(e)
+        return future.result()
+
+MEDIA_REGISTRY = MediaRegistry()
+
+def upload_media_to_sw6(media_url, media_folder_id, filename_base, extension, alt_text, download_cache=None,
+                        thumbnail_queue=None):
+    # Every file is created and uploaded only once per run, even when products share it
+    return MEDIA_REGISTRY.resolve(
+        (filename_base, extension),
+        lambda: create_or_reuse_sw6_media(media_url, media_folder_id, filename_base, extension, alt_text,
+                                          download_cache, thumbnail_queue)
+    )
+
+def create_or_reuse_sw6_media(media_url, media_folder_id, filename_base, extension, alt_text, download_cache=None,
+                              thumbnail_queue=None):
+    file_name = f"{filename_base}.{extension}"
+    with TRACER.span('media_lookup', file=file_name):
+        # Check if media already exists
+        existing_media = MEDIA_INDEX.get(filename_base, extension)
+        if existing_media:
+            print(f"Media '{filename_base}.{extension}' already exists in SW6. Using existing media ID.")
+            # Only update the alt text if it actually changed
+            if (existing_media['alt'] or '') != (alt_text or ''):
+                update_media_alt_text(existing_media['id'], alt_text)
+                MEDIA_INDEX.add(filename_base, extension, existing_media['id'], alt_text)
+            return existing_media['id']
+
+    with TRACER.span('media_upload', file=file_name):
+        # For binary uploads, download the file first, so a failed download leaves no empty media entity
+        file_path = download_cache.get(media_url) if download_cache else None
+
+        # The media ID is derived from the file name, so shards uploading the same file share one media entity
+        media_id = sw6_entity_id('media', f"{filename_base}.{extension}")
+
+        # Create the media entity in SW6 with the specified media_id and mediaFolderId
+        payload = {
+            "id": media_id,
+            "mediaFolderId": media_folder_id,
+            "alt": alt_text
+        }
+        sync_sw6_upsert('media', [payload])
+
+        # Upload the media file to SW6 using the media_id, either as file content or by providing the URL
+        # Include the filename without extension and the extension separately
+        upload_url = f"{SW6_API_URL}/api/_action/media/{media_id}/upload?fileName={quote(filename_base)}&extension={extension}"
+        if file_path:
+            content_type = mimetypes.guess_type(f"{filename_base}.{extension}")[0] or 'application/octet-stream'
+            # Pass the open file, so requests streams it instead of loading it into memory
+            with open(file_path, 'rb') as f:
+                response = sw6_request('POST', upload_url, data=f, headers={'Content-Type': content_type})
+        else:
+            upload_payload = {
+                "url": media_url
+            }
+            response = sw6_request('POST', upload_url, json=upload_payload)
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"Error uploading media for product: {e}")
+            print(f"Response content: {response.text}")
+            raise
+
+        MEDIA_INDEX.add(filename_base, extension, media_id, alt_text)
+        if thumbnail_queue:
+            thumbnail_queue.add(media_id)
 
-    # Return the media_id to be used for the product
-    return media_id
+        # Return the media_id to be used for the product
+        return media_id
 
 def update_media_alt_text(media_id, alt_text):
     url = f"{SW6_API_URL}/api/media/{media_id}"
     payload = {
         "alt": alt_text
     }
-    response = requests.patch(url, json=payload, headers=sw6_headers())
+    response = sw6_request('PATCH', url, json=payload)
     response.raise_for_status()
 
-def get_existing_product_media(product_id):
-    url = f"{SW6_API_URL}/api/search/product-media"
-    payload = {
-        "filter": [
-            {"type": "equals", "field": "productId", "value": product_id}
-        ],
-        "includes": {
-            "product_media": ["id", "mediaId", "position"]
-        },
-        "limit": 50  # Adjust as needed
-    }
-    response = requests.post(url, json=payload, headers=sw6_headers())
+# Default location of the media IDs waiting for deferred thumbnail generation
+THUMBNAIL_QUEUE_FILE = 'deferred-thumbnails.txt'
+
+# SW6 media action that generates the thumbnails of one media entity
+THUMBNAIL_ACTION_PATH = '/api/_action/media/{media_id}/generate-thumbnails'
+
+# Media moved to the target folder and sent to thumbnail generation per chunk
+THUMBNAIL_CHUNK_SIZE = 100
+
+def get_deferred_thumbnail_folder_id():
+    # Media folder whose configuration does not create thumbnails, used as upload target with
+    # --defer-thumbnails. Upserted with fixed IDs, so every run and shard uses the same folder.
+    folder_name = f"{SW6_MEDIA_FOLDER_NAME} (thumbnails pending)"
+    configuration_id = sw6_entity_id('media_folder_configuration', folder_name)
+    media_folder_id = sw6_entity_id('media_folder', folder_name)
+    sync_sw6_upsert('media_folder_configuration', [{
+        "id": configuration_id,
+        "createThumbnails": False
+    }])
+    sync_sw6_upsert('media_folder', [{
+        "id": media_folder_id,
+        "name": folder_name,
+        "useParentConfiguration": False,
+        "configurationId": configuration_id
+    }])
+    return media_folder_id
+
+class ThumbnailQueue:
+    # Append-only file of uploaded media IDs whose thumbnails are generated after the product loop.
+    # The file survives an interrupted run, so the 'thumbnails' command can finish the work later.
+
+    def __init__(self, path=THUMBNAIL_QUEUE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def add(self, media_id):
+        with self.lock:
+            self.file.write(f"{media_id}\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def generate_sw6_thumbnails(media_id):
+    url = SW6_API_URL + THUMBNAIL_ACTION_PATH.format(media_id=media_id)
+    response = sw6_request('POST', url)
     response.raise_for_status()
-    data = response.json()
-    return data.get('data', [])
+
+def generate_deferred_thumbnails(queue_path, media_folder_id, workers=4):
+    # Move the queued media into the target folder in chunks and generate their thumbnails in parallel.
+    # Media that failed stay in the queue file for the next attempt.
+    if not os.path.exists(queue_path):
+        print(f"No deferred thumbnails queued in '{queue_path}'.")
+        return
+    with open(queue_path, encoding='utf-8') as f:
+        media_ids = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    print(f"Generating thumbnails for {len(media_ids)} media with {workers} workers.")
+
+    started = time.time()
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(media_ids), THUMBNAIL_CHUNK_SIZE):
+            chunk = media_ids[start:start + THUMBNAIL_CHUNK_SIZE]
+            try:
+                sync_sw6_upsert('media', [{"id": media_id, "mediaFolderId": media_folder_id} for media_id in chunk])
+            except requests.exceptions.HTTPError as e:
+                print(f"Error moving media to the target folder: {e}")
+                failed.extend(chunk)
+                continue
+            futures = {executor.submit(generate_sw6_thumbnails, media_id): media_id for media_id in chunk}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error generating thumbnails for media {futures[future]}: {e}")
+                    failed.append(futures[future])
+            print(f"Generated thumbnails for {min(start + THUMBNAIL_CHUNK_SIZE, len(media_ids)) - len(failed)}"
+                  f"/{len(media_ids)} media.")
+
+    if failed:
+        temp_path = f"{queue_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.writelines(f"{media_id}\n" for media_id in failed)
+        os.replace(temp_path, queue_path)
+        print(f"Thumbnail generation failed for {len(failed)} media, they stay queued in '{queue_path}'.")
+    else:
+        os.remove(queue_path)
+    print(f"Thumbnail phase finished in {time.time() - started:.0f}s.")
+
+class CategoryIndex:
+    # In-memory name -> ID index of all SW6 categories, loaded once per run.
+    # Misses for the same name are serialized, so each missing category is created once.
+
+    def __init__(self):
+        self.ids = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.name_locks = {}
+
+    def load(self, page_size=500):
+        ids = {}
+        payload = {
+            "includes": {
+                "category": ["id", "name"]
+            }
+        }
+        for categories in sw6_search_all('category', payload, page_size):
+            for category in categories:
+                # Keep the first match per name, like the former per-name search did
+                if category.get('name'):
+                    ids.setdefault(category['name'], category['id'])
+        with self.lock:
+            for name, category_id in ids.items():
+                self.ids.setdefault(name, category_id)
+            self.loaded = True
+        print(f"Loaded {len(ids)} categories from SW6.")
+
+    def add(self, name, category_id):
+        with self.lock:
+            self.ids.setdefault(name, category_id)
+
+    def get(self, name):
+        with self.lock:
+            return self.ids.get(name)
+
+    def ensure_loaded(self):
+        with self.load_lock:
+            if not self.loaded:
+                self.load()
+
+    def get_or_create(self, name):
+        self.ensure_loaded()
+        with self.lock:
+            if name in self.ids:
+                return self.ids[name]
+            name_lock = self.name_locks.setdefault(name, threading.Lock())
+        with name_lock:
+            # Another worker may have created the category while we were waiting
+            category_id = self.get(name)
+            if category_id:
+                return category_id
+            print(f"Category '{name}' not found in SW6. Creating category.")
+            return create_sw6_category(name)
+
+CATEGORY_INDEX = CategoryIndex()
 
 def get_sw6_category_ids(category_names):
     category_ids = []
     for name in category_names:
-        url = f"{SW6_API_URL}/api/search/category"
-        payload = {
-            "filter": [
-                {"type": "equals", "field": "name", "value": name}
-            ],
-            "limit": 1
-        }
-        response = requests.post(url, json=payload, headers=sw6_headers())
-        response.raise_for_status()
-        data = response.json()
-        total = data.get('total', 0)
-        if total > 0 and data.get('data'):
-            category_id = data['data'][0]['id']
+        category_id = CATEGORY_INDEX.get_or_create(name)
+        if category_id:
             category_ids.append({"id": category_id})
         else:
-            print(f"Category '{name}' not found in SW6. Creating category.")
-            # Create the category
-            category_id = create_sw6_category(name)
-            if category_id:
-                category_ids.append({"id": category_id})
-            else:
-                print(f"Failed to create category '{name}'. Skipping this category.")
+            print(f"Failed to create category '{name}'. Skipping this category.")
     return category_ids
 
 def create_sw6_category(name):
-    url = f"{SW6_API_URL}/api/category"
-    category_id = uuid.uuid4().hex
+    # Upsert with an ID derived from the name, so shards creating the same category get the same one
+    category_id = sw6_entity_id('category', name)
     payload = {
         "id": category_id,
         "name": name
     }
-    response = requests.post(url, json=payload, headers=sw6_headers())
     try:
-        response.raise_for_status()
-        return category_id
-    except Exception as e:
+        sync_sw6_upsert('category', [payload])
+    except requests.exceptions.HTTPError as e:
         print(f"Error creating category '{name}': {e}")
-        print(f"Response content: {response.text}")
+        print(f"Response content: {e.response.text}")
         return None
+    CATEGORY_INDEX.add(name, category_id)
+    return category_id
 
 def update_sw6_product(product_id, update_data):
     url = f"{SW6_API_URL}/api/product/{product_id}"
-    response = requests.patch(url, json=update_data, headers=sw6_headers())
+    response = sw6_request('PATCH', url, json=update_data)
     response.raise_for_status()
 
-def get_existing_product_visibilities(product_id):
-    url = f"{SW6_API_URL}/api/search/product-visibility"
+def sync_sw6_upsert(entity, payloads, queue_indexing=False):
+    # Upsert several entities in one request through the SW6 Sync API
+    url = f"{SW6_API_URL}/api/_action/sync"
+    headers = {}
+    if queue_indexing:
+        # Let the message queue rebuild the indexes instead of indexing inline
+        headers['indexing-behavior'] = 'use-queue-indexing'
     payload = {
-        "filter": [
-            {"type": "equals", "field": "productId", "value": product_id}
-        ],
-        "includes": {
-            "product_visibility": ["id", "salesChannelId", "visibility"]
-        },
-        "limit": 50  # Adjust as needed
+        f"{entity}-upsert": {
+            "entity": entity,
+            "action": "upsert",
+            "payload": payloads
+        }
     }
-    response = requests.post(url, json=payload, headers=sw6_headers())
+    response = sw6_request('POST', url, json=payload, headers=headers)
     response.raise_for_status()
-    data = response.json()
-    return data.get('data', [])
+
+def sync_sw6_products(payloads, queue_indexing=False):
+    sync_sw6_upsert('product', payloads, queue_indexing)
+
+def get_sw6_error_details(response):
+    # Extract readable error messages from a SW6 error response
+    try:
+        data = response.json()
+    except ValueError:
+        return response.text
+    errors = data.get('errors') if isinstance(data, dict) else None
+    if not errors:
+        return response.text
+    return "; ".join(str(error.get('detail') or error.get('title') or error) for error in errors)
+
+class SyncProductWriter:
+    # Collects product update payloads and writes them in chunks via the Sync API.
+    # The Sync API runs each request in one transaction, so a failing chunk is split
+    # in halves and retried until the failing products are isolated and reported.
+
+    def __init__(self, batch_size, queue_indexing=False, on_result=None):
+        self.batch_size = batch_size
+        self.queue_indexing = queue_indexing
+        # Called with (article_number, error, exception, product_id) for every product once its chunk
+        # was written, error and exception are None on success
+        self.on_result = on_result
+        self.pending = []
+        self.written = 0
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def add(self, article_number, update_data):
+        with self.lock:
+            self.pending.append((article_number, update_data))
+            if len(self.pending) < self.batch_size:
+                return
+            chunk = self.pending
+            self.pending = []
+        self._write(chunk)
+
+    def flush(self):
+        with self.lock:
+            chunk = self.pending
+            self.pending = []
+        if chunk:
+            self._write(chunk)
+
+    def _write(self, chunk):
+        print(f"Writing {len(chunk)} products via Sync API...")
+        self._write_chunk(chunk)
+
+    def _write_chunk(self, chunk):
+        try:
+            sync_sw6_products([update_data for _, update_data in chunk], self.queue_indexing)
+        except requests.exceptions.HTTPError as e:
+            if len(chunk) > 1:
+                middle = len(chunk) // 2
+                self._write_chunk(chunk[:middle])
+                self._write_chunk(chunk[middle:])
+                return
+            article_number, update_data = chunk[0]
+            error = get_sw6_error_details(e.response) if e.response is not None else str(e)
+            self._record_failure(article_number, update_data, error, e)
+            return
+        except Exception as e:
+            # Not a rejected payload (e.g. connection error), so splitting would not help
+            for article_number, update_data in chunk:
+                self._record_failure(article_number, update_data, str(e), e)
+            return
+        with self.lock:
+            self.written += len(chunk)
+        for article_number, update_data in chunk:
+            print(f"Product {article_number} updated successfully.")
+            if self.on_result:
+                self.on_result(article_number, None, None, update_data['id'])
+
+    def _record_failure(self, article_number, update_data, error, exception):
+        print(f"Error updating product {article_number}: {error}")
+        with self.lock:
+            self.failed.append((article_number, error))
+        if self.on_result:
+            self.on_result(article_number, error, exception, update_data['id'])
 
 def to_bool(val):
     if isinstance(val, bool):
@@ -383,259 +1850,1367 @@ def to_bool(val):
         return bool(val)
     return False
 
-def get_tax_id_by_rate(tax_rate):
-    url = f"{SW6_API_URL}/api/search/tax"
+# Local cache for SW6 reference data (sales channel, media folder and taxes)
+REFERENCE_CACHE_FILE = '.sw6-reference-cache.json'
+REFERENCE_CACHE_TTL = 24 * 3600
+
+# Tax rate -> SW6 tax ID, filled from the reference data in main()
+TAX_IDS = {}
+
+def tax_rate_key(tax_rate):
+    return f"{float(tax_rate):.2f}"
+
+def get_sw6_tax_ids():
+    # Load all taxes in one request, there are only a handful of them
     payload = {
-        "filter": [
-            {
-                "type": "equals",
-                "field": "taxRate",
-                "value": tax_rate
-            }
-        ],
-        "limit": 1
+        "includes": {
+            "tax": ["id", "taxRate"]
+        },
+        "limit": 500
     }
-    response = requests.post(url, json=payload, headers=sw6_headers())
+    response = sw6_search('tax', payload)
     response.raise_for_status()
     data = response.json()
-    if data.get('data'):
-        return data['data'][0]['id']
+    tax_ids = {}
+    for tax in data.get('data', []):
+        tax_ids.setdefault(tax_rate_key(tax['taxRate']), tax['id'])
+    return tax_ids
+
+def get_tax_id_by_rate(tax_rate):
+    tax_id = TAX_IDS.get(tax_rate_key(tax_rate))
+    if tax_id:
+        return tax_id
     else:
         raise Exception(f"No tax rate {tax_rate}% found in SW6.")
 
-def main():
-    get_sw6_token()
-    try:
-        sales_channel_id, language_id, default_currency_id = get_sales_channel_info()
-    except Exception as e:
-        print(f"Error retrieving sales channel, language ID, or currency ID: {e}")
-        return
+def reference_cache_key():
+    # Cached IDs are only valid for the same shop, sales channel and media folder
+    return {
+        "sw6_api_url": SW6_API_URL,
+        "sales_channel_name": SALES_CHANNEL_NAME,
+        "media_folder_name": SW6_MEDIA_FOLDER_NAME
+    }
+
+def read_reference_cache(cache_file, ttl):
     try:
-        media_folder_id = get_sw6_media_folder_id()
-    except Exception as e:
-        print(f"Error retrieving media folder: {e}")
-        return
+        with open(cache_file, encoding='utf-8') as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable reference data cache '{cache_file}': {e}")
+        return None
+    if cache.get('key') != reference_cache_key():
+        return None
+    if time.time() - cache.get('created_at', 0) > ttl:
+        return None
+    return cache.get('data')
 
-    sw6_products = get_sw6_products()
-    total_products = len(sw6_products)  # Total number of products
+def write_reference_cache(cache_file, data):
+    cache = {
+        "key": reference_cache_key(),
+        "created_at": time.time(),
+        "data": data
+    }
+    # Write to a temporary file first, so parallel runs never read a partial cache
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_file, cache_file)
+
+def load_reference_data(cache_file=REFERENCE_CACHE_FILE, ttl=REFERENCE_CACHE_TTL, refresh=False):
+    if not refresh:
+        data = read_reference_cache(cache_file, ttl)
+        if data:
+            print(f"Using cached SW6 reference data from '{cache_file}'.")
+            return data
+
+    sales_channel_id, language_id, currency_id = get_sales_channel_info()
+    data = {
+        "sales_channel_id": sales_channel_id,
+        "language_id": language_id,
+        "currency_id": currency_id,
+        "media_folder_id": get_sw6_media_folder_id(),
+        "taxes": get_sw6_tax_ids()
+    }
+    try:
+        write_reference_cache(cache_file, data)
+    except OSError as e:
+        print(f"Could not write reference data cache '{cache_file}': {e}")
+    return data
+
+class MigrationContext:
+    # Shared, read-only settings for migrating a single product
+    def __init__(self, sales_channel_id, language_id, currency_id, media_folder_id, sw5_articles,
+                 product_writer=None, journal=None, skip_unchanged=True, download_cache=None,
+                 thumbnail_queue=None):
+        self.sales_channel_id = sales_channel_id
+        self.language_id = language_id
+        self.currency_id = currency_id
+        self.media_folder_id = media_folder_id
+        self.sw5_articles = sw5_articles
+        self.product_writer = product_writer
+        self.journal = journal
+        self.skip_unchanged = skip_unchanged
+        self.download_cache = download_cache
+        self.thumbnail_queue = thumbnail_queue
+
+class ProgressTracker:
+    # Thread-safe progress counter for the product loop
+    def __init__(self, total):
+        self.total = total
+        self.started = 0
+        self.finished = 0
+        self.outcomes = {}
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def finish(self, status):
+        with self.lock:
+            self.finished += 1
+            self.outcomes[status] = self.outcomes.get(status, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.started_at
+            products_per_minute = self.finished / elapsed * 60 if elapsed > 0 else 0.0
+            remaining = max(self.total - self.finished, 0)
+            eta_seconds = round(remaining / products_per_minute * 60) if products_per_minute else None
+            return {
+                "total": self.total,
+                "finished": self.finished,
+                "outcomes": dict(self.outcomes),
+                "elapsed_seconds": round(elapsed, 3),
+                "products_per_minute": round(products_per_minute, 2),
+                "eta_seconds": eta_seconds
+            }
 
-    for idx, sw6_product in enumerate(sw6_products, start=1):
-        article_number = sw6_product.get('productNumber')
-        if not article_number:
-            print(f"Product ID {sw6_product['id']} does not have a product number.")
-            continue
+    def start(self, article_number):
+        with self.lock:
+            self.started += 1
+            idx = self.started
+            # Calculate progress
+            products_remaining = self.total - idx
+            percentage_complete = (idx / self.total) * 100 if self.total else 100.0
+            elapsed = time.time() - self.started_at
+            products_per_minute = self.finished / elapsed * 60 if elapsed > 0 else 0.0
+            if products_per_minute:
+                eta = time.strftime('%H:%M:%S', time.gmtime(max(self.total - self.finished, 0) / products_per_minute * 60))
+                rate = f", {products_per_minute:.1f} products/min, ETA {eta}"
+            else:
+                rate = ""
+            print(f"Processing product {idx}/{self.total} with article number: {article_number} "
+                  f"({products_remaining} remaining, {percentage_complete:.2f}% complete{rate})")
+
+# Default location of the dead-letter file
+DEAD_LETTER_FILE = 'migration-dead-letters.jsonl'
+
+class DeadLetterQueue:
+    # JSONL file with one entry per failed product or media: the phase it failed in, the error class,
+    # the HTTP status and a reference to the payload. --retry-failed migrates only these products again.
+
+    def __init__(self, path=DEAD_LETTER_FILE):
+        self.path = path
+        self.count = 0
+        self.lock = threading.Lock()
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def add(self, kind, article_number, phase, message, exception=None, http_status=None, reference=None):
+        response = getattr(exception, 'response', None)
+        if http_status is None and response is not None:
+            http_status = response.status_code
+        entry = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "kind": kind,
+            "product_number": article_number,
+            "phase": phase,
+            "error_class": type(exception).__name__ if exception is not None else None,
+            "http_status": http_status,
+            "error": message,
+            "reference": reference or {}
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_dead_letters(path=DEAD_LETTER_FILE):
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line))
+    return entries
+
+def merge_shard_dead_letters(path, shard_count):
+    # Concatenate the dead-letter files of all shards. Without any shard file the existing
+    # file is left alone, it may belong to an unsharded run.
+    shard_files = [shard_path(path, (index, shard_count)) for index in range(1, shard_count + 1)]
+    shard_files = [shard_file for shard_file in shard_files if os.path.exists(shard_file)]
+    if not shard_files:
+        print(f"No shard dead-letter files found for '{path}'.")
+        return
+    entries = 0
+    with open(path, 'w', encoding='utf-8') as merged:
+        for shard_file in shard_files:
+            with open(shard_file, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        merged.write(line if line.endswith("\n") else line + "\n")
+                        entries += 1
+    print(f"Merged {entries} dead-letter entries from {len(shard_files)} shards into '{path}'.")
+
+class ErrorCollector:
+    # Thread-safe collection of per-product errors for the run summary,
+    # also written to the dead-letter file if there is one
+    def __init__(self, dead_letters=None):
+        self.errors = []
+        self.dead_letters = dead_letters
+        self.lock = threading.Lock()
+
+    def add(self, article_number, message, phase='migrate', exception=None, reference=None, kind='product'):
+        with self.lock:
+            self.errors.append((article_number, message))
+            print(message)
+        if self.dead_letters:
+            self.dead_letters.add(kind, article_number, phase, message, exception, reference=reference)
+
+    def skip(self, article_number, message, phase, http_status=None, reference=None):
+        # Not counted as an error, but written to the dead-letter file so it can be retried
+        print(message)
+        if self.dead_letters:
+            self.dead_letters.add('product', article_number, phase, message, http_status=http_status,
+                                  reference=reference)
+
+    def failed_products(self):
+        with self.lock:
+            return sorted({article_number for article_number, _ in self.errors})
+
+    def last_error(self, article_number):
+        with self.lock:
+            for number, message in reversed(self.errors):
+                if number == article_number:
+                    return message
+        return None
 
-        # Calculate progress
-        products_remaining = total_products - idx
-        percentage_complete = (idx / total_products) * 100
+# Default location of the migration journal
+JOURNAL_FILE = 'migration-journal.sqlite'
+
+class MigrationJournal:
+    # SQLite journal of per-product outcomes (done, failed, skipped) and the SW6 media IDs
+    # used for each product, so an interrupted run can be resumed.
+    # Records are buffered and written in one transaction per batch to keep the loop fast.
+
+    # Keep recorded media IDs when a later record only updates the status
+    UPSERT = (
+        "INSERT INTO products (product_number, status, media, error, payload_hash, updated_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT(product_number) DO UPDATE SET"
+        " status = excluded.status,"
+        " media = COALESCE(excluded.media, products.media),"
+        " error = excluded.error,"
+        " payload_hash = COALESCE(excluded.payload_hash, products.payload_hash),"
+        " updated_at = excluded.updated_at"
+    )
+
+    def __init__(self, path=JOURNAL_FILE, flush_size=200, flush_interval=5.0):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_flush = time.time()
+        self.completed = set()
+        self.media = {}
+        self.hashes = {}
+        self.pending_hashes = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS products ("
+            " product_number TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " media TEXT,"
+            " error TEXT,"
+            " payload_hash TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(products)")]
+        if 'payload_hash' not in columns:
+            # Journal written by an older version of this script
+            self.connection.execute("ALTER TABLE products ADD COLUMN payload_hash TEXT")
+        self.connection.commit()
+
+    def load(self, resume=False):
+        # Read the payload hashes of earlier runs and, for --resume, their outcomes
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT product_number, status, media, payload_hash FROM products").fetchall()
+        for product_number, status, media, payload_hash in rows:
+            if payload_hash:
+                self.hashes[product_number] = payload_hash
+            if not resume:
+                continue
+            # Journals of earlier versions recorded unchanged products as 'unchanged'
+            if status in ('done', 'unchanged'):
+                self.completed.add(product_number)
+            elif media:
+                self.media[product_number] = json.loads(media)
+        if resume:
+            print(f"Journal '{self.path}': {len(self.completed)} products already done.")
+
+    def is_completed(self, article_number):
+        return article_number in self.completed
+
+    def get_media(self, article_number):
+        return self.media.get(article_number, {})
+
+    def get_hash(self, article_number):
+        return self.hashes.get(article_number)
+
+    def set_pending_hash(self, article_number, payload_hash):
+        # Remember the hash of a payload until its write is recorded as done
+        with self.lock:
+            self.pending_hashes[article_number] = payload_hash
+
+    def record(self, article_number, status, media=None, error=None, payload_hash=None):
+        media_json = json.dumps(media, sort_keys=True) if media is not None else None
+        with self.lock:
+            pending_hash = self.pending_hashes.pop(article_number, None) if status != 'in_progress' else None
+            if status == 'done' and payload_hash is None:
+                payload_hash = pending_hash
+            self.pending.append((article_number, status, media_json, error, payload_hash, time.time()))
+            if len(self.pending) < self.flush_size and time.time() - self.last_flush < self.flush_interval:
+                return
+            self._flush()
+
+    def _flush(self):
+        # Must be called with the lock held
+        if self.pending:
+            self.connection.executemany(self.UPSERT, self.pending)
+            self.connection.commit()
+            self.pending = []
+        self.last_flush = time.time()
+
+    def merge(self, path):
+        # Import all records of another journal, e.g. the journal of one shard
+        source = sqlite3.connect(path)
+        try:
+            rows = source.execute(
+                "SELECT product_number, status, media, error, payload_hash, updated_at FROM products"
+                " ORDER BY updated_at").fetchall()
+        finally:
+            source.close()
+        with self.lock:
+            self._flush()
+            self.connection.executemany(self.UPSERT, rows)
+            self.connection.commit()
+        statuses = {}
+        for row in rows:
+            statuses[row[1]] = statuses.get(row[1], 0) + 1
+        return statuses
+
+    def failures(self):
+        with self.lock:
+            self._flush()
+            return self.connection.execute(
+                "SELECT product_number, error FROM products WHERE status = 'failed' ORDER BY product_number"
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.connection.close()
+
+def parse_shard(value):
+    # --shard i/N, with shards numbered from 1 to N
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', expected i/N, e.g. 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', i must be between 1 and N")
+    return index, count
+
+def product_shard(article_number, shard_count):
+    # Stable across processes and machines, unlike hash()
+    digest = hashlib.sha256(article_number.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count + 1
+
+def product_in_shard(sw6_product, shard):
+    article_number = sw6_product.get('productNumber')
+    if not article_number:
+        # Products without a number are reported by the first shard only
+        return shard[0] == 1
+    return product_shard(article_number, shard[1]) == shard[0]
+
+def shard_path(path, shard):
+    # migration-journal.sqlite -> migration-journal.shard-2-of-4.sqlite
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard-{shard[0]}-of-{shard[1]}{extension}"
+
+def merge_shard_journals(path, shard_count):
+    # Combine the journals of all shards into one journal and list the failed products
+    journal = MigrationJournal(path)
+    totals = {}
+    missing = []
+    try:
+        for index in range(1, shard_count + 1):
+            shard_file = shard_path(path, (index, shard_count))
+            if not os.path.exists(shard_file):
+                print(f"Journal of shard {index}/{shard_count} not found: {shard_file}")
+                missing.append(index)
+                continue
+            statuses = journal.merge(shard_file)
+            print(f"Shard {index}/{shard_count}: "
+                  + ", ".join(f"{count} {status}" for status, count in sorted(statuses.items())))
+            for status, count in statuses.items():
+                totals[status] = totals.get(status, 0) + count
+        failures = journal.failures()
+    finally:
+        journal.close()
+
+    print(f"Merged {shard_count - len(missing)} of {shard_count} shard journals into '{path}': "
+          + ", ".join(f"{count} {status}" for status, count in sorted(totals.items())))
+    if failures:
+        print(f"{len(failures)} failed products:")
+        for article_number, error in failures:
+            print(f"  {article_number}: {error}")
+    if missing:
+        print(f"Missing shards: {', '.join(str(index) for index in missing)}")
+
+def canonical_product_hash(update_data):
+    # Hash of the product payload that ignores generated IDs and the order of associations,
+    # so the same desired state always hashes the same
+    canonical = dict(update_data)
+    media = update_data.get('media') or []
+    product_media_ids = {pm.get('id'): pm['mediaId'] for pm in media}
+    canonical['media'] = sorted(([pm['mediaId'], pm.get('position')] for pm in media), key=lambda pm: pm[0])
+    canonical['coverId'] = product_media_ids.get(update_data.get('coverId'))
+    canonical['visibilities'] = sorted(
+        [visibility['salesChannelId'], visibility['visibility']] for visibility in update_data.get('visibilities') or []
+    )
+    if 'categories' in update_data:
+        canonical['categories'] = sorted(category['id'] for category in update_data['categories'])
+    serialized = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+# Visibility of migrated products in the sales channel (30 for "All")
+PRODUCT_VISIBILITY_ALL = 30
+
+def gross_price(net_price, tax_rate):
+    # SW5 prices are net prices
+    return round(net_price * (1 + tax_rate / 100), 2)
+
+def sw5_product_texts(sw5_product):
+    return {
+        "description": sw5_product.get('descriptionLong') or sw5_product.get('description'),
+        "metaTitle": sw5_product.get('metaTitle'),
+        "metaDescription": sw5_product.get('description')  # Use 'description' for metaDescription
+    }
 
-        # Updated print statement with progress indicators
-        print(f"Processing product {idx}/{total_products} with article number: {article_number} "
-              f"({products_remaining} remaining, {percentage_complete:.2f}% complete)")
+def sw5_product_images(sw5_product):
+    images = sw5_product.get('images', [])
+    if not images and sw5_product.get('mainDetail', {}).get('images'):
+        images = sw5_product['mainDetail']['images']
+    return images
 
-        sw5_product = get_sw5_product(article_number)
+def sw5_product_custom_fields(sw5_product):
+    attribute = sw5_product.get('mainDetail', {}).get('attribute', {})
+    return {
+        "sim_protected_price": to_bool(attribute.get('attr4', False)),
+        "sim_warenpost": to_bool(attribute.get('warenpost', False))
+    }
 
-        if sw5_product:
-            # For debugging: print SW5 product data
-            # Uncomment the lines below to see the SW5 product data
-            # print(f"SW5 Product Data for {article_number}:")
-            # print(json.dumps(sw5_product, indent=4))
+def migrate_product(sw6_product, context, errors):
+    article_number = sw6_product['productNumber']
+    product_reference = {"product_id": sw6_product['id']}
+    try:
+        with TRACER.span('sw5_fetch'):
+            sw5_product = context.sw5_articles.get(article_number)
+    except Exception as e:
+        errors.add(article_number, f"Error fetching product {article_number} from SW5: {e}", 'sw5_fetch', e,
+                   product_reference)
+        return 'failed'
+    if not sw5_product:
+        errors.skip(article_number, f"Product {article_number} not found in SW5. Skipping.", 'sw5_fetch', 404,
+                    product_reference)
+        return 'skipped'
+
+    # For debugging: print SW5 product data
+    # Uncomment the lines below to see the SW5 product data
+    # print(f"SW5 Product Data for {article_number}:")
+    # print(json.dumps(sw5_product, indent=4))
+
+    # Get the tax rate from SW5 product
+    tax_rate = sw5_product.get('tax', {}).get('tax', 19.0)  # Default to 19% if not specified
+    try:
+        tax_rate = float(tax_rate)  # Ensure tax_rate is a float
+    except ValueError as e:
+        errors.add(article_number, f"Invalid tax rate '{tax_rate}' for product {article_number}. Skipping.", 'tax',
+                   e, product_reference)
+        return 'failed'
 
-            # Get the tax rate from SW5 product
-            tax_rate = sw5_product.get('tax', {}).get('tax', 19.0)  # Default to 19% if not specified
-            try:
-                tax_rate = float(tax_rate)  # Ensure tax_rate is a float
-            except ValueError:
-                print(f"Invalid tax rate '{tax_rate}' for product {article_number}. Skipping.")
+    # Get the tax ID in SW6 corresponding to this tax rate
+    try:
+        tax_id = get_tax_id_by_rate(tax_rate)
+    except Exception as e:
+        errors.add(article_number, f"Error retrieving tax ID for tax rate {tax_rate}%: {e}", 'tax', e,
+                   product_reference)
+        return 'failed'
+
+    # Get the standard price from SW5
+    prices = sw5_product.get('mainDetail', {}).get('prices', [])
+    if prices:
+        # Assuming the first price is the standard price
+        sw5_price = prices[0].get('price')
+    else:
+        sw5_price = None
+
+    if sw5_price is not None:
+        try:
+            # SW5 price is net price
+            net_price = float(sw5_price)
+        except ValueError as e:
+            errors.add(article_number, f"Invalid net price '{sw5_price}' for product {article_number}. Skipping.",
+                       'price', e, product_reference)
+            return 'failed'
+
+        price_data = [
+            {
+                "currencyId": context.currency_id,
+                "gross": gross_price(net_price, tax_rate),
+                "net": net_price,
+                "linked": False  # Prices are not linked
+            }
+        ]
+    else:
+        price_data = None
+
+    # Extract data from SW5 product
+    texts = sw5_product_texts(sw5_product)
+    active_state = to_bool(sw5_product.get('active', True))  # Ensure boolean type
+
+    # Existing product media, loaded with the product page
+    existing_product_media = sw6_product.get('media') or []
+    existing_media_map = {pm['mediaId']: pm for pm in existing_product_media}
+
+    # Extract images from SW5 product
+    images = sw5_product_images(sw5_product)
+
+    media_ids = []
+
+    # Media IDs recorded for this product by an earlier, interrupted run
+    recorded_media = context.journal.get_media(article_number) if context.journal else {}
+    used_media = {}
+
+    if images and context.download_cache:
+        # Start downloading all new files of this product in parallel before uploading them one by one
+        for idx_img, image in enumerate(images):
+            media_data = get_sw5_media(image['mediaId']) if image.get('mediaId') else None
+            if media_data:
+                sw5_media_url, filename_base, extension, _ = get_sw5_image_info(media_data, idx_img)
+                if not MEDIA_INDEX.get(filename_base, extension):
+                    context.download_cache.prefetch(sw5_media_url)
+
+    if images:
+        for idx_img, image in enumerate(images):
+            media_id = image.get('mediaId')
+            if not media_id:
                 continue
-
-            # Get the tax ID in SW6 corresponding to this tax rate
+            # Fetch media data using media_id
+            media_data = get_sw5_media(media_id)
+            if not media_data:
+                continue
+            sw5_media_url, filename_base, extension, alt_text = get_sw5_image_info(media_data, idx_img)
+            # Upload media to SW6 or use existing media
             try:
-                tax_id = get_tax_id_by_rate(tax_rate)
+                print(f"Processing file: {filename_base}.{extension}")
+                media_key = f"{filename_base}.{extension}"
+                if media_key in recorded_media:
+                    sw6_media_id = recorded_media[media_key]
+                    print(f"Reusing media ID recorded in the journal for {media_key}.")
+                else:
+                    sw6_media_id = upload_media_to_sw6(sw5_media_url, context.media_folder_id, filename_base, extension,
+                                                       alt_text, context.download_cache, context.thumbnail_queue)
+                used_media[media_key] = sw6_media_id
+
+                # Check if media is already associated with the product
+                if sw6_media_id in existing_media_map:
+                    print(f"Media {filename_base}.{extension} is already associated with product {article_number}.")
+                    # Use existing ProductMedia entry and update position if necessary
+                    product_media_entry = existing_media_map[sw6_media_id]
+                    product_media_entry['position'] = idx_img
+                else:
+                    # Create new ProductMedia entry
+                    product_media_id = uuid.uuid4().hex
+                    product_media_entry = {
+                        "id": product_media_id,
+                        "mediaId": sw6_media_id,
+                        "position": idx_img
+                    }
+                media_ids.append(product_media_entry)
+
             except Exception as e:
-                print(f"Error retrieving tax ID for tax rate {tax_rate}%: {e}")
+                errors.add(article_number, f"Error uploading media for product {article_number}: {e}\n"
+                                           f"Filename: {filename_base}.{extension}\n"
+                                           f"Media URL: {sw5_media_url}",
+                           'media_upload', e, {"product_id": sw6_product['id'], "sw5_media_id": media_id,
+                                               "file_name": f"{filename_base}.{extension}", "url": sw5_media_url},
+                           'media')
                 continue
+        # Set the first image as the cover image
+        if media_ids:
+            cover_id = media_ids[0]['id']  # Use the 'id' of the product media
+        else:
+            cover_id = None
+    else:
+        media_ids = []
+        cover_id = None
+
+    if context.journal:
+        context.journal.record(article_number, 'in_progress', media=used_media)
+
+    # Combine existing and new media entries, ensuring no duplicates
+    all_media_entries = list({pm['mediaId']: pm for pm in existing_product_media + media_ids}.values())
+
+    category_names = [category['name'] for category in sw5_product.get('categories', [])]
+
+    # Get SW6 category IDs (create if not exists)
+    with TRACER.span('categories', count=len(category_names)):
+        sw6_category_ids = get_sw6_category_ids(category_names)
+    if not sw6_category_ids:
+        print(f"No matching categories found in SW6 for product {article_number}. Skipping category assignment.")
+        sw6_category_ids = []
+
+    # Extract custom fields from SW5
+    custom_fields = sw5_product_custom_fields(sw5_product)
+
+    # Existing visibilities, loaded with the product page
+    existing_visibilities = sw6_product.get('visibilities') or []
+
+    # Prepare the visibility entry
+    visibilities = []
+    existing_visibility = next(
+        (vis for vis in existing_visibilities if vis['salesChannelId'] == context.sales_channel_id),
+        None
+    )
+
+    if existing_visibility:
+        # Update existing visibility
+        visibilities.append({
+            "id": existing_visibility['id'],
+            "productId": sw6_product['id'],
+            "salesChannelId": context.sales_channel_id,
+            "visibility": PRODUCT_VISIBILITY_ALL
+        })
+    else:
+        # Create new visibility. The ID is derived from product and sales channel, so a retried write
+        # that SW6 already committed updates the same entry instead of violating its unique key.
+        visibilities.append({
+            "id": sw6_entity_id('product_visibility', f"{sw6_product['id']}:{context.sales_channel_id}"),
+            "productId": sw6_product['id'],
+            "salesChannelId": context.sales_channel_id,
+            "visibility": PRODUCT_VISIBILITY_ALL
+        })
+
+    # Prepare update data
+    update_data = {
+        "id": sw6_product['id'],
+        "active": active_state,
+        "customFields": custom_fields,
+        "translations": {
+            context.language_id: texts
+        },
+        "media": all_media_entries,
+        "visibilities": visibilities,
+        "price": price_data,
+        "taxId": tax_id
+    }
+    if sw6_category_ids:
+        update_data["categories"] = sw6_category_ids
+    if cover_id:
+        update_data["coverId"] = cover_id
+
+    # Skip the write if the same payload was already written successfully
+    if context.journal:
+        payload_hash = canonical_product_hash(update_data)
+        if context.skip_unchanged and context.journal.get_hash(article_number) == payload_hash:
+            print(f"Product {article_number} is unchanged since the last successful update. Skipping update.")
+            context.journal.record(article_number, 'done', payload_hash=payload_hash)
+            return 'unchanged'
+        context.journal.set_pending_hash(article_number, payload_hash)
+
+    # Update product in SW6
+    if context.product_writer:
+        # Includes writing the whole chunk when this product fills it
+        with TRACER.span('product_write', mode='sync'):
+            context.product_writer.add(article_number, update_data)
+        return 'queued'
+    try:
+        with TRACER.span('product_write', mode='patch'):
+            update_sw6_product(sw6_product['id'], update_data)
+        print(f"Product {article_number} updated successfully.")
+    except Exception as e:
+        errors.add(article_number, f"Error updating product {article_number}: {e}", 'product_write', e,
+                   product_reference)
+        return 'failed'
+    return 'done'
 
-            # Get the standard price from SW5
-            prices = sw5_product.get('mainDetail', {}).get('prices', [])
-            if prices:
-                # Assuming the first price is the standard price
-                sw5_price = prices[0].get('price')
-            else:
-                sw5_price = None
-
-            if sw5_price is not None:
-                try:
-                    # SW5 price is net price
-                    net_price = float(sw5_price)
-                except ValueError:
-                    print(f"Invalid net price '{sw5_price}' for product {article_number}. Skipping.")
-                    continue
-
-                # Calculate gross price based on the net price and tax rate
-                gross_price = net_price * (1 + tax_rate / 100)
-                gross_price = round(gross_price, 2)  # Optional rounding
+# Default location of the verification report. It uses the dead-letter format, so
+# --retry-failed --dead-letter-file <report> migrates the mismatched products again.
+VERIFY_REPORT_FILE = 'migration-verify.jsonl'
 
-                price_data = [
-                    {
-                        "currencyId": default_currency_id,
-                        "gross": gross_price,
-                        "net": net_price,
-                        "linked": False  # Prices are not linked
-                    }
-                ]
-            else:
-                price_data = None
+# Prices differing by less than this are equal, SW6 stores them as floats
+PRICE_TOLERANCE = 0.005
 
-            # Extract data from SW5 product
-            description = sw5_product.get('descriptionLong') or sw5_product.get('description')
-            meta_title = sw5_product.get('metaTitle')
-            meta_description = sw5_product.get('description')  # Use 'description' for metaDescription
-            active_state = to_bool(sw5_product.get('active', True))  # Ensure boolean type
+def sw6_verify_search_payload(page_size, language_id):
+    # Product search with everything verify_product() compares
+    return {
+        "associations": {
+            "media": {"associations": {"media": {}}},
+            "visibilities": {},
+            "categories": {},
+            "translations": {
+                "filter": [{"type": "equals", "field": "languageId", "value": language_id}]
+            }
+        },
+        "includes": {
+            "product": ["id", "productNumber", "active", "price", "taxId", "customFields", "coverId",
+                        "media", "visibilities", "categories", "translations"],
+            "product_media": ["id", "mediaId", "media"],
+            "media": ["fileName", "fileExtension"],
+            "product_visibility": ["salesChannelId", "visibility"],
+            "category": ["name"],
+            "product_translation": ["languageId", "description", "metaTitle", "metaDescription"]
+        },
+        "sort": [{"field": "productNumber", "order": "ASC"}],
+        "limit": page_size,
+        "total-count-mode": 0
+    }
 
-            # Fetch existing product media
-            existing_product_media = get_existing_product_media(sw6_product['id'])
-            existing_media_map = {pm['mediaId']: pm for pm in existing_product_media}
+def expected_media_files(sw5_product):
+    # File names of the SW5 images in their order, named like migrate_product() uploads them
+    files = []
+    for idx_img, image in enumerate(sw5_product_images(sw5_product)):
+        media_data = get_sw5_media(image['mediaId']) if image.get('mediaId') else None
+        if media_data:
+            _, filename_base, extension, _ = get_sw5_image_info(media_data, idx_img)
+            files.append(f"{filename_base}.{extension}")
+    return files
 
-            # Extract images from SW5 product
-            images = sw5_product.get('images', [])
-            if not images and sw5_product.get('mainDetail', {}).get('images'):
-                images = sw5_product['mainDetail']['images']
+def compare_product(sw5_product, sw6_product, context):
+    # Recompute what migrate_product() writes and return the fields SW6 differs in,
+    # as field -> {"expected": ..., "actual": ...}
+    differences = {}
 
-            media_ids = []
+    def check(field, expected, actual):
+        if expected != actual:
+            differences[field] = {"expected": expected, "actual": actual}
 
-            if images:
-                for idx_img, image in enumerate(images):
-                    media_id = image.get('mediaId')
-                    if not media_id:
-                        continue
-                    # Fetch media data using media_id
-                    media_data = get_sw5_media(media_id)
-                    if not media_data:
-                        continue
-                    # Get media URL, filename base, extension, and alt text
-                    sw5_media_url, extension = get_sw5_media_url_and_extension(media_data)
-                    filename_base = media_data.get('name', f"image_{idx_img}")
-                    filename_base = os.path.splitext(filename_base)[0]  # Remove existing extension
-                    if not extension:
-                        extension = 'jpg'  # Default to 'jpg' if extension is missing
-                    alt_text = media_data.get('description', '')
-                    # Upload media to SW6 or use existing media
-                    try:
-                        print(f"Processing file: {filename_base}.{extension}")
-                        sw6_media_id = upload_media_to_sw6(sw5_media_url, media_folder_id, filename_base, extension, alt_text)
-
-                        # Check if media is already associated with the product
-                        if sw6_media_id in existing_media_map:
-                            print(f"Media {filename_base}.{extension} is already associated with product {article_number}.")
-                            # Use existing ProductMedia entry and update position if necessary
-                            product_media_entry = existing_media_map[sw6_media_id]
-                            product_media_entry['position'] = idx_img
-                        else:
-                            # Create new ProductMedia entry
-                            product_media_id = uuid.uuid4().hex
-                            product_media_entry = {
-                                "id": product_media_id,
-                                "mediaId": sw6_media_id,
-                                "position": idx_img
-                            }
-                        media_ids.append(product_media_entry)
+    check('active', to_bool(sw5_product.get('active', True)), sw6_product.get('active'))
 
-                    except Exception as e:
-                        print(f"Error uploading media for product {article_number}: {e}")
-                        print(f"Filename: {filename_base}.{extension}")
-                        print(f"Media URL: {sw5_media_url}")
-                        continue
-                # Set the first image as the cover image
-                if media_ids:
-                    cover_id = media_ids[0]['id']  # Use the 'id' of the product media
-                else:
-                    cover_id = None
-            else:
-                media_ids = []
-                cover_id = None
+    tax_rate = sw5_product.get('tax', {}).get('tax', 19.0)
+    try:
+        tax_rate = float(tax_rate)
+    except ValueError:
+        differences['tax'] = {"expected": f"valid tax rate, not '{tax_rate}'", "actual": sw6_product.get('taxId')}
+        tax_rate = None
+    if tax_rate is not None:
+        check('tax', TAX_IDS.get(tax_rate_key(tax_rate), f"tax rate {tax_rate_key(tax_rate)}%"),
+              sw6_product.get('taxId'))
+
+    prices = sw5_product.get('mainDetail', {}).get('prices', [])
+    sw5_price = prices[0].get('price') if prices else None
+    if sw5_price is not None and tax_rate is not None:
+        price = next((price for price in sw6_product.get('price') or []
+                      if price.get('currencyId') == context.currency_id), {})
+        actual = {"net": price.get('net'), "gross": price.get('gross')}
+        try:
+            net_price = float(sw5_price)
+        except ValueError:
+            differences['price'] = {"expected": f"valid net price, not '{sw5_price}'", "actual": actual}
+        else:
+            expected = {"net": net_price, "gross": gross_price(net_price, tax_rate)}
+            if any(not isinstance(actual[key], (int, float)) or abs(expected[key] - actual[key]) >= PRICE_TOLERANCE
+                   for key in expected):
+                differences['price'] = {"expected": expected, "actual": actual}
+
+    translation = next((translation for translation in sw6_product.get('translations') or []
+                        if translation.get('languageId') == context.language_id), {})
+    for field, expected in sw5_product_texts(sw5_product).items():
+        # SW6 stores empty texts as null
+        check(field, expected or None, translation.get(field) or None)
+
+    custom_fields = sw6_product.get('customFields') or {}
+    for field, expected in sw5_product_custom_fields(sw5_product).items():
+        check(f"customFields.{field}", expected, custom_fields.get(field))
+
+    visibility = next((visibility['visibility'] for visibility in sw6_product.get('visibilities') or []
+                       if visibility.get('salesChannelId') == context.sales_channel_id), None)
+    check('visibility', PRODUCT_VISIBILITY_ALL, visibility)
+
+    # Migration only adds categories and media, so SW6 may have more than SW5
+    category_names = {category.get('name') for category in sw6_product.get('categories') or []}
+    missing_categories = sorted({category['name'] for category in sw5_product.get('categories', [])} - category_names)
+    if missing_categories:
+        differences['categories'] = {"expected": missing_categories, "actual": None}
+
+    media_files = {}
+    for product_media in sw6_product.get('media') or []:
+        media = product_media.get('media') or {}
+        media_files[product_media['id']] = f"{media.get('fileName')}.{media.get('fileExtension')}"
+    expected_files = expected_media_files(sw5_product)
+    missing_files = [file for file in expected_files if file not in media_files.values()]
+    if missing_files:
+        differences['media'] = {"expected": len(expected_files), "actual": len(expected_files) - len(missing_files),
+                                "missing": missing_files}
+    if expected_files:
+        check('cover', expected_files[0], media_files.get(sw6_product.get('coverId')))
+
+    return differences
+
+def verify_product(sw6_product, context):
+    # Returns the status ('ok', 'mismatch', 'missing' in SW5 or 'failed') and the differences or error
+    article_number = sw6_product['productNumber']
+    try:
+        sw5_product = context.sw5_articles.get(article_number)
+        if not sw5_product:
+            return 'missing', None
+        differences = compare_product(sw5_product, sw6_product, context)
+    except Exception as e:
+        return 'failed', e
+    return ('mismatch' if differences else 'ok'), differences
+
+def verify_migration(context, report, workers=1, shard=None, page_size=500):
+    # Compare all SW6 products with their SW5 articles. The SW5 articles of each page of SW6
+    # products are prefetched and the page is compared in parallel; mismatches and errors go to the report.
+    started = time.time()
+    counts = {}
+    fields = {}
+
+    def record(sw6_product, result):
+        status, details = result
+        article_number = sw6_product['productNumber']
+        counts[status] = counts.get(status, 0) + 1
+        reference = {"product_id": sw6_product['id']}
+        if status == 'mismatch':
+            for field in details:
+                fields[field] = fields.get(field, 0) + 1
+            print(f"Product {article_number} differs in {', '.join(details)}.")
+            report.add('product', article_number, 'verify', f"Mismatched fields: {', '.join(details)}",
+                       reference=dict(reference, differences=details))
+        elif status == 'failed':
+            print(f"Error verifying product {article_number}: {details}")
+            report.add('product', article_number, 'verify', f"Error verifying product: {details}", details,
+                       reference=reference)
+        elif status == 'missing':
+            print(f"Product {article_number} not found in SW5.")
+
+    def search_payload(size):
+        return sw6_verify_search_payload(size, context.language_id)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for products in get_sw6_products(page_size, search_payload):
+            products = [product for product in products
+                        if product.get('productNumber') and (not shard or product_in_shard(product, shard))]
+            context.sw5_articles.prefetch([product['productNumber'] for product in products])
+            for product, result in zip(products, executor.map(lambda product: verify_product(product, context),
+                                                              products)):
+                record(product, result)
+            print(f"Verified {sum(counts.values())} products, {counts.get('mismatch', 0)} mismatched.")
+
+    print(f"Verification finished in {time.time() - started:.0f}s: {counts.get('ok', 0)} matching, "
+          f"{counts.get('mismatch', 0)} mismatched, {counts.get('failed', 0)} failed, "
+          f"{counts.get('missing', 0)} not found in SW5.")
+    for field, count in sorted(fields.items(), key=lambda item: item[1], reverse=True):
+        print(f"  {field}: {count} {'product' if count == 1 else 'products'}")
+    return counts
+
+# Default location of the metrics summary
+METRICS_FILE = 'migration-metrics.json'
+
+# Number of SW6 products fetched and migrated per page
+PRODUCT_PAGE_SIZE = 500
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate product data and media from Shopware 5 to Shopware 6.")
+    parser.add_argument('command', nargs='?', choices=('migrate', 'snapshot', 'merge', 'thumbnails', 'verify'),
+                        default='migrate',
+                        help="'migrate' products (default), export SW5 articles and media to a 'snapshot' file, "
+                             "'merge' the journals of all shards, generate the queued deferred 'thumbnails', "
+                             "or 'verify' the migrated products against SW5")
+    parser.add_argument('--source', choices=('api', 'snapshot'), default='api',
+                        help="Read SW5 articles and media from the SW5 API (default) or from the snapshot file")
+    parser.add_argument('--snapshot-file', default=SNAPSHOT_FILE,
+                        help=f"SQLite file written by the snapshot command (default: {SNAPSHOT_FILE})")
+    parser.add_argument('--shard', type=parse_shard,
+                        help="Only migrate shard i of N, e.g. 2/4, selected by a hash of the product number. "
+                             "Journal and metrics files get a shard suffix")
+    parser.add_argument('--shards', type=int,
+                        help="Number of shards whose journals the merge command combines")
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help="Write products in chunks of this size via the SW6 Sync API "
+                             "(default: 0, one PATCH per product)")
+    parser.add_argument('--queue-indexing', action='store_true',
+                        help="Send 'indexing-behavior: use-queue-indexing' with Sync API writes")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of products to migrate in parallel (default: 1)")
+    parser.add_argument('--prefetch-sw5', action='store_true',
+                        help="Page through the SW5 article listing once and prefetch article details "
+                             "in parallel, instead of one request per product number")
+    parser.add_argument('--prefetch-workers', type=int, default=8,
+                        help="Parallel SW5 requests used by --prefetch-sw5 and the snapshot command (default: 8)")
+    parser.add_argument('--prefetch-sw5-media', action='store_true',
+                        help="Page through SW5 /api/media once at startup to fill the media metadata cache")
+    parser.add_argument('--sw5-media-album', type=int,
+                        help="Only prefetch or export SW5 media of this album ID (e.g. -1 for the article album)")
+    parser.add_argument('--journal', default=JOURNAL_FILE,
+                        help=f"SQLite file recording the outcome of every product (default: {JOURNAL_FILE})")
+    parser.add_argument('--no-journal', action='store_true',
+                        help="Do not record product outcomes in the journal")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip products the journal marks as done and reuse recorded media IDs")
+    parser.add_argument('--no-skip-unchanged', action='store_true',
+                        help="Write every product, even if the journal shows the same payload was already written")
+    parser.add_argument('--binary-upload', action='store_true',
+                        help="Download SW5 media files locally and upload their content to SW6, "
+                             "instead of letting SW6 fetch each file by URL")
+    parser.add_argument('--download-cache', default=DOWNLOAD_CACHE_DIR,
+                        help=f"Directory of the content-addressed media download cache (default: {DOWNLOAD_CACHE_DIR})")
+    parser.add_argument('--download-workers', type=int, default=8,
+                        help="Parallel media downloads for --binary-upload (default: 8)")
+    parser.add_argument('--defer-thumbnails', action='store_true',
+                        help="Upload media to a folder without thumbnail generation and generate the thumbnails "
+                             "in a bulk phase after all products are written")
+    parser.add_argument('--thumbnail-queue', default=THUMBNAIL_QUEUE_FILE,
+                        help=f"File of media IDs waiting for deferred thumbnails (default: {THUMBNAIL_QUEUE_FILE})")
+    parser.add_argument('--thumbnail-workers', type=int, default=4,
+                        help="Parallel thumbnail generation requests (default: 4)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only migrate products whose SW5 article changed since the last incremental run")
+    parser.add_argument('--since',
+                        help="Start of the incremental run as 'YYYY-MM-DD HH:MM:SS' in SW5 shop time, "
+                             "instead of the stored high-water mark")
+    parser.add_argument('--sync-state', default=SYNC_STATE_FILE,
+                        help=f"File storing the high-water mark of incremental runs (default: {SYNC_STATE_FILE})")
+    parser.add_argument('--verify-report', default=VERIFY_REPORT_FILE,
+                        help=f"JSONL file listing the products 'verify' found different in SW6, in the dead-letter "
+                             f"format (default: {VERIFY_REPORT_FILE})")
+    parser.add_argument('--dead-letter-file', default=DEAD_LETTER_FILE,
+                        help=f"JSONL file listing every failed product and media (default: {DEAD_LETTER_FILE}, "
+                             f"empty to disable)")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="Only migrate the products listed in the dead-letter file")
+    parser.add_argument('--retry-workers', type=int, default=2,
+                        help="Number of products migrated in parallel by --retry-failed (default: 2)")
+    parser.add_argument('--retry-max-retries', type=int, default=8,
+                        help="Retries per request for --retry-failed (default: 8)")
+    parser.add_argument('--retry-backoff', type=float, default=5.0,
+                        help="Base delay in seconds of the exponential backoff for --retry-failed (default: 5)")
+    parser.add_argument('--sw5-rate-limit', type=float, default=SW5_RATE_LIMIT,
+                        help="Maximum requests per second to SW5, lowered automatically while SW5 throttles "
+                             "(default: unlimited, only bounded by --workers until SW5 throttles)")
+    parser.add_argument('--sw6-rate-limit', type=float, default=SW6_RATE_LIMIT,
+                        help="Maximum requests per second to SW6, lowered automatically while SW6 throttles "
+                             "(default: unlimited, only bounded by --workers until SW6 throttles)")
+    parser.add_argument('--download-rate-limit', type=float, default=DOWNLOAD_RATE_LIMIT,
+                        help="Maximum media downloads per second for --binary-upload, lowered automatically while "
+                             "the media host throttles (default: unlimited, only bounded by --download-workers)")
+    parser.add_argument('--max-retries', type=int, default=MAX_RETRIES,
+                        help=f"Retries for throttled or failed requests (default: {MAX_RETRIES})")
+    parser.add_argument('--metrics-file', default=METRICS_FILE,
+                        help=f"JSON file for the request and throughput summary written at the end "
+                             f"(default: {METRICS_FILE}, empty to disable)")
+    parser.add_argument('--prometheus-file',
+                        help="Prometheus textfile with live request and progress metrics, "
+                             "e.g. for the node exporter textfile collector")
+    parser.add_argument('--prometheus-interval', type=float, default=15.0,
+                        help="Seconds between updates of the Prometheus textfile (default: 15)")
+    parser.add_argument('--compress-requests', action='store_true',
+                        help="Gzip large JSON request bodies to SW6; the web server has to decode them")
+    parser.add_argument('--compress-min-bytes', type=int, default=COMPRESS_MIN_BYTES,
+                        help=f"Minimum body size in bytes compressed by --compress-requests (default: {COMPRESS_MIN_BYTES})")
+    parser.add_argument('--log-requests', action='store_true',
+                        help="Print every request with its status, payload sizes and duration")
+    parser.add_argument('--trace-file',
+                        help="Write a Chrome/Perfetto trace-event JSON file with spans for every product phase")
+    parser.add_argument('--trace-top', type=int, default=10,
+                        help="Number of slowest products listed by phase at the end of a traced run (default: 10)")
+    parser.add_argument('--reference-cache', default=REFERENCE_CACHE_FILE,
+                        help=f"File caching sales channel, media folder and tax IDs (default: {REFERENCE_CACHE_FILE})")
+    parser.add_argument('--reference-cache-ttl', type=int, default=REFERENCE_CACHE_TTL,
+                        help=f"Maximum age of the reference data cache in seconds (default: {REFERENCE_CACHE_TTL})")
+    parser.add_argument('--refresh-reference-cache', action='store_true',
+                        help="Ignore the reference data cache and look everything up again")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.retry_failed:
+        # Failed products are often failing because a shop was overloaded, so retry them gently
+        args.workers = args.retry_workers
+        configure_rate_limits(args.sw5_rate_limit, args.sw6_rate_limit, args.download_rate_limit, args.retry_max_retries, args.retry_backoff)
+    else:
+        configure_rate_limits(args.sw5_rate_limit, args.sw6_rate_limit, args.download_rate_limit, args.max_retries)
+    configure_http_sessions(max(args.workers, args.prefetch_workers, args.download_workers))
+    configure_payloads(args.compress_requests, args.compress_min_bytes, args.log_requests)
+
+    if args.command == 'merge':
+        if not args.shards or args.shards < 1:
+            print("The merge command requires --shards N.")
+            return
+        merge_shard_journals(args.journal, args.shards)
+        if args.dead_letter_file:
+            merge_shard_dead_letters(args.dead_letter_file, args.shards)
+        return
 
-            # Combine existing and new media entries, ensuring no duplicates
-            all_media_entries = list({pm['mediaId']: pm for pm in existing_product_media + media_ids}.values())
+    if args.shard:
+        # Each shard writes its own files, the merge command combines the journals afterwards
+        args.journal = shard_path(args.journal, args.shard)
+        if args.metrics_file:
+            args.metrics_file = shard_path(args.metrics_file, args.shard)
+        if args.prometheus_file:
+            args.prometheus_file = shard_path(args.prometheus_file, args.shard)
+        args.thumbnail_queue = shard_path(args.thumbnail_queue, args.shard)
+        if args.dead_letter_file:
+            args.dead_letter_file = shard_path(args.dead_letter_file, args.shard)
+        if args.trace_file:
+            args.trace_file = shard_path(args.trace_file, args.shard)
+
+    if args.command == 'snapshot':
+        create_sw5_snapshot(args.snapshot_file, args.prefetch_workers, args.sw5_media_album)
+        METRICS.print_summary()
+        return
 
-            category_names = [category['name'] for category in sw5_product.get('categories', [])]
+    if args.command == 'thumbnails':
+        SW6_TOKENS.refresh()
+        try:
+            reference_data = load_reference_data(args.reference_cache, args.reference_cache_ttl,
+                                                 args.refresh_reference_cache)
+        except Exception as e:
+            print(f"Error retrieving the media folder: {e}")
+            return
+        generate_deferred_thumbnails(args.thumbnail_queue, reference_data['media_folder_id'], args.thumbnail_workers)
+        METRICS.print_summary()
+        return
 
-            # Get SW6 category IDs (create if not exists)
-            sw6_category_ids = get_sw6_category_ids(category_names)
-            if not sw6_category_ids:
-                print(f"No matching categories found in SW6 for product {article_number}. Skipping category assignment.")
-                sw6_category_ids = []
+    if args.command == 'verify':
+        if args.shard:
+            args.verify_report = shard_path(args.verify_report, args.shard)
+        SW6_TOKENS.refresh()
+        try:
+            reference_data = load_reference_data(args.reference_cache, args.reference_cache_ttl,
+                                                 args.refresh_reference_cache)
+        except Exception as e:
+            print(f"Error retrieving sales channel, media folder or taxes: {e}")
+            return
+        TAX_IDS.update(reference_data['taxes'])
+
+        snapshot = None
+        if args.source == 'snapshot':
+            try:
+                snapshot = SW5Snapshot(args.snapshot_file)
+            except (FileNotFoundError, ValueError, sqlite3.Error) as e:
+                print(f"Error opening SW5 snapshot: {e}")
+                return
+            SW5_MEDIA_CACHE.fetch = snapshot.get_media
+            sw5_articles = snapshot
+        else:
+            if args.prefetch_sw5_media:
+                try:
+                    SW5_MEDIA_CACHE.prefetch(args.sw5_media_album)
+                except Exception as e:
+                    print(f"Error prefetching SW5 media, falling back to fetching media on demand: {e}")
+            # Verifying reads every article, so always page through the listing and prefetch the details
+            sw5_articles = SW5ArticleStore(get_sw5_article_listing(workers=args.prefetch_workers),
+                                           args.prefetch_workers)
+
+        context = MigrationContext(reference_data['sales_channel_id'], reference_data['language_id'],
+                                   reference_data['currency_id'], reference_data['media_folder_id'], sw5_articles)
+        report = DeadLetterQueue(args.verify_report)
+        try:
+            verify_migration(context, report, args.workers, args.shard)
+        finally:
+            report.close()
+            if snapshot:
+                snapshot.close()
+        if report.count:
+            print(f"Wrote {report.count} products to '{args.verify_report}', migrate them again with "
+                  f"--retry-failed --dead-letter-file {args.verify_report}")
+        METRICS.print_summary()
+        return
 
-            # Extract custom fields from SW5
-            attr4 = sw5_product.get('mainDetail', {}).get('attribute', {}).get('attr4', False)
-            warenpost = sw5_product.get('mainDetail', {}).get('attribute', {}).get('warenpost', False)
+    if args.incremental and (args.retry_failed or args.source == 'snapshot'):
+        print("--incremental reads changes from the SW5 API and cannot be combined with "
+              "--retry-failed or --source snapshot.")
+        return
+    if args.shard:
+        args.sync_state = shard_path(args.sync_state, args.shard)
+    since = None
+    if args.incremental:
+        since = args.since or read_sync_state(args.sync_state).get('high_water_mark')
+        if not since:
+            print(f"No high-water mark in '{args.sync_state}' yet, pass --since 'YYYY-MM-DD HH:MM:SS' "
+                  f"for the first incremental run.")
+            return
+
+    retry_numbers = None
+    if args.retry_failed:
+        if not args.dead_letter_file:
+            print("--retry-failed requires the dead-letter file, set --dead-letter-file.")
+            return
+        try:
+            entries = read_dead_letters(args.dead_letter_file)
+        except FileNotFoundError:
+            print(f"Dead-letter file '{args.dead_letter_file}' not found, nothing to retry.")
+            return
+        retry_numbers = list(dict.fromkeys(entry['product_number'] for entry in entries if entry.get('product_number')))
+        if not retry_numbers:
+            print(f"No failed products in '{args.dead_letter_file}', nothing to retry.")
+            return
+        print(f"Retrying {len(retry_numbers)} products from {len(entries)} dead-letter entries "
+              f"with {args.workers} workers.")
+
+    snapshot = None
+    if args.source == 'snapshot':
+        try:
+            snapshot = SW5Snapshot(args.snapshot_file)
+        except (FileNotFoundError, ValueError, sqlite3.Error) as e:
+            print(f"Error opening SW5 snapshot: {e}")
+            return
+
+    journal = None
+    if not args.no_journal:
+        journal = MigrationJournal(args.journal)
+        # Retried products were recorded as done if only their media failed, so they must not be skipped
+        journal.load(args.resume and not args.retry_failed)
+    elif args.resume:
+        print("--resume requires the journal, remove --no-journal.")
+        return
 
-            # Convert to boolean
-            sim_protected_price = to_bool(attr4)
-            sim_warenpost = to_bool(warenpost)
+    dead_letters = None
+    if args.dead_letter_file:
+        # A retry writes the remaining failures next to the file and replaces it once the retry finished
+        dead_letters = DeadLetterQueue(f"{args.dead_letter_file}.retry" if args.retry_failed else args.dead_letter_file)
 
-            custom_fields = {
-                "sim_protected_price": sim_protected_price,
-                "sim_warenpost": sim_warenpost
-            }
+    def record_write_result(article_number, error, exception=None, product_id=None):
+        if journal:
+            journal.record(article_number, 'failed' if error else 'done', error=error)
+        if error and dead_letters:
+            dead_letters.add('product', article_number, 'product_write', error, exception,
+                             reference={"product_id": product_id})
 
-            # Fetch existing visibilities for the product
-            existing_visibilities = get_existing_product_visibilities(sw6_product['id'])
-
-            # Prepare the visibility entry
-            visibilities = []
-            existing_visibility = next(
-                (vis for vis in existing_visibilities if vis['salesChannelId'] == sales_channel_id),
-                None
-            )
-
-            if existing_visibility:
-                # Update existing visibility
-                visibilities.append({
-                    "id": existing_visibility['id'],
-                    "productId": sw6_product['id'],
-                    "salesChannelId": sales_channel_id,
-                    "visibility": 30  # Desired visibility level (30 for "All")
-                })
-            else:
-                # Create new visibility
-                visibilities.append({
-                    "productId": sw6_product['id'],
-                    "salesChannelId": sales_channel_id,
-                    "visibility": 30  # Desired visibility level
-                })
-
-            # Prepare update data
-            update_data = {
-                "id": sw6_product['id'],
-                "active": active_state,
-                "customFields": custom_fields,
-                "translations": {
-                    language_id: {
-                        "description": description,
-                        "metaTitle": meta_title,
-                        "metaDescription": meta_description
-                    }
-                },
-                "media": all_media_entries,
-                "visibilities": visibilities,
-                "price": price_data,
-                "taxId": tax_id
-            }
-            if sw6_category_ids:
-                update_data["categories"] = sw6_category_ids
-            if cover_id:
-                update_data["coverId"] = cover_id
+    if args.batch_size > 0:
+        product_writer = SyncProductWriter(args.batch_size, args.queue_indexing, record_write_result)
+    else:
+        product_writer = None
 
-            # Update product in SW6
+    SW6_TOKENS.refresh()
+    try:
+        reference_data = load_reference_data(args.reference_cache, args.reference_cache_ttl,
+                                             args.refresh_reference_cache)
+    except Exception as e:
+        print(f"Error retrieving sales channel, media folder or taxes: {e}")
+        return
+    TAX_IDS.update(reference_data['taxes'])
+
+    CATEGORY_INDEX.ensure_loaded()
+    MEDIA_INDEX.ensure_loaded()
+
+    upload_folder_id = reference_data['media_folder_id']
+    thumbnail_queue = None
+    if args.defer_thumbnails:
+        try:
+            upload_folder_id = get_deferred_thumbnail_folder_id()
+        except requests.exceptions.HTTPError as e:
+            print(f"Error creating the media folder for deferred thumbnails: {e}")
+            return
+        thumbnail_queue = ThumbnailQueue(args.thumbnail_queue)
+
+    download_cache = None
+    if args.binary_upload:
+        download_cache = MediaDownloadCache(args.download_cache, args.download_workers)
+
+    incremental_numbers = None
+    high_water_mark = None
+    changed_at = {}
+    if snapshot:
+        # Read all SW5 data from the snapshot, the media cache still keeps recently used records
+        SW5_MEDIA_CACHE.fetch = snapshot.get_media
+        sw5_articles = snapshot
+    elif args.incremental:
+        changed_articles = get_sw5_changed_articles(since, workers=args.prefetch_workers)
+        # The next run continues from the newest change SW5 reported, so clock skew between hosts does not matter.
+        # Changes in the same second are synced again, which skip-unchanged makes cheap.
+        high_water_mark = max(filter(None, (sw5_changed_timestamp(a) for a in changed_articles.values())),
+                              default=since)
+        # Variant numbers are not in the listing, their failures fall back to the previous mark
+        changed_at = {number: sw5_changed_timestamp(a) or since for number, a in changed_articles.items()}
+        changed_at[None] = since
+        sw5_articles = SW5ArticleStore(changed_articles, args.prefetch_workers)
+        sw5_articles.prefetch(list(changed_articles))
+        # Include variant numbers, SW6 products may use them as product numbers
+        incremental_numbers = sorted(sw5_articles.product_numbers() | set(changed_articles))
+    else:
+        if args.prefetch_sw5_media:
             try:
-                update_sw6_product(sw6_product['id'], update_data)
-                print(f"Product {article_number} updated successfully.")
+                SW5_MEDIA_CACHE.prefetch(args.sw5_media_album)
             except Exception as e:
-                print(f"Error updating product {article_number}: {e}")
+                print(f"Error prefetching SW5 media, falling back to fetching media on demand: {e}")
 
+        if args.prefetch_sw5:
+            sw5_articles = SW5ArticleStore(get_sw5_article_listing(workers=args.prefetch_workers),
+                                           args.prefetch_workers)
         else:
-            print(f"Product {article_number} not found in SW5. Skipping.")
+            sw5_articles = SW5ArticleStore()
+
+    context = MigrationContext(reference_data['sales_channel_id'], reference_data['language_id'],
+                               reference_data['currency_id'], upload_folder_id, sw5_articles,
+                               product_writer, journal, not args.no_skip_unchanged, download_cache, thumbnail_queue)
+    errors = ErrorCollector(dead_letters)
+
+    if retry_numbers:
+        total_products = len(retry_numbers)
+    elif incremental_numbers is not None:
+        total_products = len(incremental_numbers)
+    else:
+        total_products = count_sw6_products()
+    if args.shard and not retry_numbers and incremental_numbers is None:
+        # The hash spreads products evenly, so each shard gets about 1/N of them
+        total_products = -(-total_products // args.shard[1])
+        print(f"Migrating shard {args.shard[0]}/{args.shard[1]} with about {total_products} products.")
+    progress = ProgressTracker(total_products)
+    prometheus_writer = None
+    if args.prometheus_file:
+        prometheus_writer = PrometheusTextfileWriter(args.prometheus_file, args.prometheus_interval, progress)
+        prometheus_writer.start()
+
+    def process_product(sw6_product):
+        article_number = sw6_product.get('productNumber')
+        if not article_number:
+            print(f"Product ID {sw6_product['id']} does not have a product number.")
+            return
+        progress.start(article_number)
+        if journal and journal.is_completed(article_number):
+            print(f"Product {article_number} was already migrated according to the journal. Skipping.")
+            progress.finish('resumed')
+            return
+        try:
+            with TRACER.product(article_number):
+                status = migrate_product(sw6_product, context, errors)
+        except Exception as e:
+            errors.add(article_number, f"Error migrating product {article_number}: {e}", 'migrate', e,
+                       {"product_id": sw6_product['id']})
+            status = 'failed'
+        progress.finish(status)
+        # Products queued for the Sync API are recorded once their chunk was written,
+        # unchanged products were already recorded as done by migrate_product()
+        if journal and status not in ('queued', 'unchanged'):
+            journal.record(article_number, status, error=errors.last_error(article_number) if status == 'failed' else None)
+
+    if args.trace_file:
+        TRACER.open(args.trace_file, args.trace_top)
+
+    executor = None
+    if args.workers > 1:
+        print(f"Migrating products with {args.workers} workers.")
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    if retry_numbers:
+        product_pages = get_sw6_products_by_number(retry_numbers, PRODUCT_PAGE_SIZE)
+    elif incremental_numbers is not None:
+        product_pages = get_sw6_products_by_number(incremental_numbers, PRODUCT_PAGE_SIZE)
+    else:
+        product_pages = get_sw6_products(PRODUCT_PAGE_SIZE)
+
+    try:
+        # Migrate each page while it streams in, SW5 articles are prefetched per page
+        for chunk in product_pages:
+            if args.shard:
+                chunk = [p for p in chunk if product_in_shard(p, args.shard)]
+            sw5_articles.prefetch([p['productNumber'] for p in chunk if p.get('productNumber')])
+            if executor:
+                for future in as_completed([executor.submit(process_product, p) for p in chunk]):
+                    future.result()
+            else:
+                for sw6_product in chunk:
+                    process_product(sw6_product)
+        if product_writer:
+            product_writer.flush()
+            print(f"Sync API writes finished: {product_writer.written} products written, "
+                  f"{len(product_writer.failed)} failed.")
+            for article_number, error in product_writer.failed:
+                print(f"  Failed product {article_number}: {error}")
+        if thumbnail_queue:
+            # All products are live, now generate the thumbnails of the new media in one go
+            thumbnail_queue.close()
+            generate_deferred_thumbnails(args.thumbnail_queue, reference_data['media_folder_id'],
+                                         args.thumbnail_workers)
+    finally:
+        if executor:
+            executor.shutdown()
+        if journal:
+            journal.close()
+        if snapshot:
+            snapshot.close()
+        if thumbnail_queue:
+            thumbnail_queue.close()
+        if dead_letters:
+            dead_letters.close()
+        if download_cache:
+            download_cache.close()
+        if prometheus_writer:
+            prometheus_writer.stop()
+        TRACER.close()
+        if args.metrics_file:
+            try:
+                METRICS.write_summary(args.metrics_file, progress)
+            except OSError as e:
+                print(f"Could not write metrics summary '{args.metrics_file}': {e}")
+
+    if retry_numbers:
+        # Only replace the dead letters once every product was retried
+        os.replace(dead_letters.path, args.dead_letter_file)
+    if high_water_mark:
+        # The next run rewrites the dead-letter file, so it has to start at or before the oldest
+        # failed article to query it again
+        failed_numbers = set(errors.failed_products())
+        if product_writer:
+            failed_numbers.update(article_number for article_number, _ in product_writer.failed)
+        for article_number in failed_numbers:
+            high_water_mark = min(high_water_mark, changed_at.get(article_number, changed_at[None]))
+        write_sync_state(args.sync_state, high_water_mark)
+        print(f"Next incremental run starts at SW5 changes since {high_water_mark}.")
+
+    outcomes = progress.outcomes
+    written = outcomes.get('done', 0)
+    failed = outcomes.get('failed', 0)
+    if product_writer:
+        written += product_writer.written
+        failed += len(product_writer.failed)
+    print(f"Summary: {written} products written, {outcomes.get('unchanged', 0)} unchanged and skipped, "
+          f"{outcomes.get('skipped', 0)} not found in SW5, {outcomes.get('resumed', 0)} already done, "
+          f"{failed} failed.")
+
+    products = progress.snapshot()
+    print(f"Processed {products['finished']} products in {products['elapsed_seconds']:.0f}s "
+          f"({products['products_per_minute']:.1f} products/min).")
+    METRICS.print_summary()
+    if args.trace_file:
+        TRACER.print_report()
+        print(f"Trace written to '{args.trace_file}', open it in https://ui.perfetto.dev or chrome://tracing.")
+
+    failed_products = errors.failed_products()
+    if failed_products:
+        print(f"{len(errors.errors)} errors in {len(failed_products)} products: {', '.join(failed_products)}")
+    if dead_letters and dead_letters.count:
+        print(f"{dead_letters.count} failures written to '{args.dead_letter_file}', "
+              f"retry them with --retry-failed.")
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file